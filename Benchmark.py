@@ -0,0 +1,326 @@
+# Jonathan Birnbaum
+
+import argparse
+import csv
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+from itertools import accumulate, count, islice, product
+from timeit import default_timer as timer
+from typing import Dict, Iterator, List, Tuple
+from Client import Client, Operations, DATA_SIZE, DEFAULT_BUCKET_SIZE, get_encrypted_bucket_size
+from Metrics import DISABLED_METRICS, Metrics
+from PartitionedClient import PartitionedClient
+from RingClient import RingClient, DEFAULT_EVICTION_RATE, DEFAULT_NUM_OF_DUMMIES, get_ring_entry_size, \
+    get_ring_server_size
+from Server import Server
+from Utils import Colors, color_text, get_tree_height, get_tree_size
+
+DEFAULT_NUM_OF_OPERATIONS = 1000
+DEFAULT_SEED = 0
+DEFAULT_TOLERANCE = 0.2  # allowed relative regression compared with the baseline
+ZIPF_EXPONENT = 0.99
+BACKENDS = ['memory', 'mmap', 'network']
+SCHEMES = ['path', 'ring']
+# workload name -> (fraction of reads, key distribution)
+WORKLOADS = {'uniform': (0.5, 'uniform'),
+             'zipfian': (0.5, 'zipfian'),
+             'read-heavy': (0.95, 'uniform'),
+             'write-heavy': (0.05, 'uniform')}
+storage_file_numbers = count()  # unique names of the tree files of the mmap backend
+# result field -> True if higher is better. used by the regression check
+COMPARED_FIELDS = {'ops_per_sec': True, 'p50_latency': False, 'p95_latency': False, 'p99_latency': False,
+                   'bytes_per_op': False, 'online_bytes_per_op': False, 'crypto_ops_per_op': False}
+
+
+# __________________ Workloads __________________
+
+def generate_workload(workload: str, N: int, num_of_operations: int, data_size: int,
+                      seed: int) -> Iterator[Tuple[str, int, bytes]]:
+    """
+    yield num_of_operations seeded operations (operation, data_id, new_data) over the data ids 0..N-1
+    """
+    read_fraction, distribution = WORKLOADS[workload]
+    rng = random.Random(seed)
+    data_ids = range(N)
+    cum_weights = None
+    if distribution == 'zipfian':
+        cum_weights = list(accumulate(1 / ((rank + 1) ** ZIPF_EXPONENT) for rank in data_ids))
+    for _ in range(num_of_operations):
+        if cum_weights is None:
+            data_id = rng.randrange(N)
+        else:
+            data_id = rng.choices(data_ids, cum_weights=cum_weights)[0]
+        if rng.random() < read_fraction:
+            yield Operations.READ, data_id, None
+        else:
+            yield Operations.WRITE, data_id, rng.randbytes(data_size)
+
+
+# __________________ Backends __________________
+
+def create_server(backend: str, storage_size: int, entry_size: int, work_dir: str, metrics: Metrics):
+    """
+    return the server object of the given backend and a function which releases it. the Server behind the
+    backend records its metrics in the given Metrics
+    :param storage_size: number of entries (buckets) of the server storage
+    :param entry_size: largest size in bytes of an entry (for the mmap backend)
+    """
+    if backend == 'memory':
+        server = Server(storage_size, metrics=metrics)
+        return server, server.close
+    if backend == 'mmap':
+        from Storage import MmapStorage
+        storage_path = os.path.join(work_dir, f'tree_{os.getpid()}_{next(storage_file_numbers)}.bin')
+        server = Server(storage_size, MmapStorage(storage_path, storage_size, entry_size), metrics)
+
+        def close_mmap():
+            server.close()
+            os.remove(storage_path)
+
+        return server, close_mmap
+    if backend == 'network':
+        from Network import NetworkServer, RemoteServer
+        network_server = NetworkServer(Server(storage_size, metrics=metrics))
+        remote_server = RemoteServer(network_server.start_in_thread())
+
+        def close_network():
+            remote_server.close()
+            network_server.stop()
+
+        return remote_server, close_network
+    raise ValueError(f'unknown backend {backend}')
+
+
+class PartitionServerFactory:
+    """
+    picklable server factory of the partitions of a PartitionedClient, which creates the servers in its worker
+    processes. the servers are released by the workers, and the tree files of the mmap backend are in work_dir
+    """
+
+    def __init__(self, backend: str, entry_size: int, work_dir: str):
+        self.backend = backend
+        self.entry_size = entry_size
+        self.work_dir = work_dir
+
+    def __call__(self, storage_size: int, metrics=DISABLED_METRICS):
+        return create_server(self.backend, storage_size, self.entry_size, self.work_dir, metrics)[0]
+
+
+# __________________ Benchmark __________________
+
+def get_percentile(sorted_values: List[float], percent: float) -> float:
+    """
+    return the given percentile of a sorted list (nearest rank)
+    """
+    rank = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def run_benchmark(N: int, bucket_size: int, backend: str, workload: str,
+                  num_of_operations: int = DEFAULT_NUM_OF_OPERATIONS, data_size: int = DATA_SIZE,
+                  seed: int = DEFAULT_SEED, work_dir: str = None, num_of_partitions: int = 1, scheme: str = 'path',
+                  num_of_dummies: int = DEFAULT_NUM_OF_DUMMIES, eviction_rate: int = DEFAULT_EVICTION_RATE) -> Dict:
+    """
+    load N data blocks, run a seeded workload and return its measurements. only the workload operations are
+    measured. leaf indices are drawn from a secure random source and are not seeded, so latencies vary between
+    runs but the bytes and crypto operations per access do not (for a single partition).
+    with more than one partition the workload runs on a PartitionedClient (a worker process per partition) in
+    batches of num_of_partitions operations, and the latency of an operation is the time of its batch.
+    the ring scheme (a single RingClient with num_of_dummies and eviction_rate) is loaded by regular writes
+    """
+    metrics = Metrics()
+    close_functions = []
+
+    def server_factory(storage_size: int, entry_size: int = get_encrypted_bucket_size(bucket_size, data_size)):
+        server, close_server = create_server(backend, storage_size, entry_size, work_dir or tempfile.gettempdir(),
+                                             metrics)
+        close_functions.append(close_server)
+        return server
+
+    preload_rng = random.Random(seed)
+    preload_items = ((data_id, preload_rng.randbytes(data_size)) for data_id in range(N))
+    client = None
+    partitions_dir = None
+    try:
+        if scheme == 'ring':
+            server = server_factory(get_ring_server_size(N, bucket_size, num_of_dummies),
+                                    get_ring_entry_size(bucket_size, num_of_dummies, data_size))
+            client = RingClient(N, server, bucket_size, data_size, num_of_dummies, eviction_rate, metrics=metrics)
+            for data_id, data in preload_items:
+                client.access(server, Operations.WRITE, data_id, data)
+
+            def serve_batch(batch: List[Tuple]):
+                for operation, data_id, new_data in batch:
+                    client.access(server, operation, data_id, new_data)
+        elif num_of_partitions == 1:
+            server = server_factory(get_tree_size(get_tree_height(N)))
+            client = Client(N, server, bucket_size, data_size, metrics=metrics)
+            client.bulk_load(server, preload_items)
+
+            def serve_batch(batch: List[Tuple]):
+                for operation, data_id, new_data in batch:
+                    client.access(server, operation, data_id, new_data)
+        else:
+            partitions_dir = tempfile.TemporaryDirectory(dir=work_dir)
+            entry_size = get_encrypted_bucket_size(bucket_size, data_size)
+            partition_server_factory = PartitionServerFactory(backend, entry_size, partitions_dir.name)
+            client = PartitionedClient(N, num_of_partitions, partition_server_factory, bucket_size, data_size,
+                                       metrics=metrics)
+            client.access_many([(Operations.WRITE, data_id, data) for data_id, data in preload_items])
+            client.collect_metrics()
+            serve_batch = client.access_many
+        metrics.reset()
+
+        latencies = []
+        workload_operations = generate_workload(workload, N, num_of_operations, data_size, seed)
+        all_requests_start = timer()
+        batch = list(islice(workload_operations, num_of_partitions))
+        while batch:
+            start = timer()
+            serve_batch(batch)
+            latencies.extend([timer() - start] * len(batch))
+            batch = list(islice(workload_operations, num_of_partitions))
+        total_time = timer() - all_requests_start
+        if isinstance(client, PartitionedClient):
+            client.collect_metrics()
+            max_stash_size = client.get_max_stash_size()
+        else:
+            max_stash_size = client.max_stash_size
+    finally:
+        if isinstance(client, PartitionedClient):
+            client.close()
+        if partitions_dir is not None:
+            partitions_dir.cleanup()
+        for close_server in close_functions:
+            close_server()
+
+    latencies.sort()
+    counters = metrics.get_counter
+    bytes_read, bytes_written = counters('server_bytes_read'), counters('server_bytes_written')
+    crypto_ops = counters('encryptions') + counters('decryptions')
+    phases = {name[:-len('_seconds')]: histogram.total / num_of_operations
+              for name, histogram in metrics.histograms.items() if name.endswith('_seconds')}
+    return {'scheme': scheme,
+            'N': N,
+            'bucket_size': bucket_size,
+            'backend': backend,
+            'workload': workload,
+            'num_of_partitions': num_of_partitions,
+            'num_of_operations': num_of_operations,
+            'seed': seed,
+            'total_time': total_time,
+            'ops_per_sec': num_of_operations / total_time,
+            'mean_latency': statistics.fmean(latencies),
+            'p50_latency': get_percentile(latencies, 50),
+            'p95_latency': get_percentile(latencies, 95),
+            'p99_latency': get_percentile(latencies, 99),
+            'round_trips_per_op': counters('server_calls') / num_of_operations,
+            'bytes_read': bytes_read,
+            'bytes_written': bytes_written,
+            'bytes_per_op': (bytes_read + bytes_written) / num_of_operations,
+            'online_bytes_per_op': counters('online_bytes') / num_of_operations,
+            'encryptions': counters('encryptions'),
+            'decryptions': counters('decryptions'),
+            'crypto_ops_per_op': crypto_ops / num_of_operations,
+            'max_stash_size': max_stash_size,
+            **{f'{phase}_seconds_per_op': seconds for phase, seconds in sorted(phases.items())}}
+
+
+def get_config_key(result: Dict) -> Tuple:
+    return result.get('scheme', 'path'), result['N'], result['bucket_size'], result['backend'], result['workload'], \
+        result.get('num_of_partitions', 1)
+
+
+def find_regressions(results: List[Dict], baseline: List[Dict], tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    return a description of every measurement which is worse than the baseline by more than tolerance
+    (relative). configurations missing from the baseline are not checked
+    """
+    baseline_by_config = {get_config_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_by_config.get(get_config_key(result))
+        if baseline_result is None:
+            continue
+        for field, higher_is_better in COMPARED_FIELDS.items():
+            value, baseline_value = result[field], baseline_result[field]
+            if higher_is_better:
+                is_regression = value < baseline_value * (1 - tolerance)
+            else:
+                is_regression = value > baseline_value * (1 + tolerance)
+            if is_regression:
+                regressions.append(f'{get_config_key(result)} {field}: {value:.6g} (baseline {baseline_value:.6g})')
+    return regressions
+
+
+def write_csv(results: List[Dict], file_path: str):
+    with open(file_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the Path ORAM client over a sweep of configurations')
+    parser.add_argument('-N', type=int, nargs='+', default=[100, 1000], help='numbers of data blocks')
+    parser.add_argument('--bucket-size', type=int, nargs='+', default=[DEFAULT_BUCKET_SIZE])
+    parser.add_argument('--backend', nargs='+', choices=BACKENDS, default=['memory'])
+    parser.add_argument('--workload', nargs='+', choices=list(WORKLOADS), default=['uniform'])
+    parser.add_argument('--scheme', nargs='+', choices=SCHEMES, default=['path'],
+                        help='path - Path ORAM, ring - Ring ORAM (compare their bytes per access with a realistic '
+                             '--data-size, e.g. 4096 - ring moves more bytes with tiny blocks)')
+    parser.add_argument('--dummies', type=int, default=DEFAULT_NUM_OF_DUMMIES,
+                        help='dummy slots per bucket (S) of ring')
+    parser.add_argument('--eviction-rate', type=int, default=DEFAULT_EVICTION_RATE,
+                        help='accesses between path evictions (A) of ring')
+    parser.add_argument('--partitions', type=int, nargs='+', default=[1],
+                        help='numbers of partitions (above 1 - partitioned ORAM over independent sub-trees)')
+    parser.add_argument('--operations', type=int, default=DEFAULT_NUM_OF_OPERATIONS,
+                        help='number of measured operations per configuration')
+    parser.add_argument('--data-size', type=int, default=DATA_SIZE)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--csv', help='write the results to this CSV file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed relative regression compared with the baseline')
+    args = parser.parse_args()
+
+    results = []
+    for scheme, N, bucket_size, backend, workload, num_of_partitions in product(
+            args.scheme, args.N, args.bucket_size, args.backend, args.workload, args.partitions):
+        if scheme == 'ring' and num_of_partitions > 1:
+            continue  # partitions are sub-trees of Path ORAM
+        result = run_benchmark(N, bucket_size, backend, workload, args.operations, args.data_size, args.seed,
+                               num_of_partitions=num_of_partitions, scheme=scheme, num_of_dummies=args.dummies,
+                               eviction_rate=args.eviction_rate)
+        results.append(result)
+        print(f'{scheme} N={N} Z={bucket_size} P={num_of_partitions} {backend} {workload}: '
+              f'{result["ops_per_sec"]:.1f} ops/s, '
+              f'p50={result["p50_latency"] * 1000:.3f}ms p95={result["p95_latency"] * 1000:.3f}ms '
+              f'p99={result["p99_latency"] * 1000:.3f}ms, {result["bytes_per_op"]:.0f} bytes/op '
+              f'({result["online_bytes_per_op"]:.0f} online), '
+              f'{result["crypto_ops_per_op"]:.1f} crypto ops/op')
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.csv:
+        write_csv(results, args.csv)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(color_text(f'Regression: {regression}', Colors.RED))
+        if regressions:
+            sys.exit(1)
+        print(color_text('No regressions compared with the baseline', Colors.GREEN))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,92 @@
 # Jonathan Birnbaum
 
-import random
-import secrets
-from typing import Union
+import struct
+from typing import Callable, Dict, Iterable, List, Tuple, Union
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
+from Metrics import DISABLED_METRICS
+from ParallelCrypto import ParallelCrypto
+from PositionMap import ArrayPositionMap, DictPositionMap
 from Server import Server
 from Utils import *
 
-DATA_SIZE = 4  # in bytes (string of 4 chars)
+DATA_SIZE = 4  # in bytes (string of 4 chars) - default size of the data of a block
 KEY_SIZE = 32  # in bytes
-NONCE_TAG_SIZE = 16  # in bytes
-DUMMY_DATA = 'XXXX'
-DUMMY_ID = 'x'
+NONCE_SIZE = 12  # in bytes
+NONCE_PREFIX_SIZE = 4  # in bytes (random part of the nonce, the rest is a counter)
+TAG_SIZE = 16  # in bytes
+INDEX_SIZE = 8  # in bytes (bucket index authenticated with each bucket)
+# block inside a bucket: is real (0 - dummy), data id, leaf index, data length. followed by data_size bytes of data
+BLOCK_HEADER_FORMAT = '>BqII'
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER_FORMAT)
+REAL_BLOCK = 1
 ROOT_INDEX = 0
+DEFAULT_BUCKET_SIZE = 4  # Z - number of blocks in each bucket
+# lazy deletes pending at most, relative to N - beyond it deletes are eager, so the stale blocks take a bounded
+# part of the tree and of the client memory
+MAX_DELETED_LEAVES_FACTOR = 0.25
+
+
+def get_block_size(data_size: int) -> int:
+    """
+    return the size in bytes of a block with data of data_size bytes
+    """
+    return BLOCK_HEADER_SIZE + data_size
+
+
+def pack_block_into(buffer: bytearray, offset: int, data_id: int, leaf_index: int, data):
+    """
+    pack a real block into the buffer at the given offset. the buffer must have room for the whole block
+    """
+    struct.pack_into(BLOCK_HEADER_FORMAT, buffer, offset, REAL_BLOCK, data_id, leaf_index, len(data))
+    data_offset = offset + BLOCK_HEADER_SIZE
+    buffer[data_offset:data_offset + len(data)] = data
+
+
+def get_encrypted_bucket_size(bucket_size: int, data_size: int = DATA_SIZE) -> int:
+    """
+    return the size in bytes of an encrypted bucket of bucket_size blocks (the slot size of the server storage)
+    """
+    return NONCE_SIZE + TAG_SIZE + (bucket_size * get_block_size(data_size))
+
+
+def encrypt_bucket_plaintext(secret_key: bytes, nonce: bytes, bucket_index: int, plaintext) -> bytearray:
+    """
+    encrypt a packed (and padded) bucket as a single AES-GCM ciphertext, the bucket index is authenticated so the
+    server can not swap buckets. a module function (not a method) so it can run in a worker process
+    :return: encrypted bucket (nonce + tag + ciphertext)
+    """
+    cipher = AES.new(secret_key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(bucket_index.to_bytes(INDEX_SIZE, 'big'))
+    # encrypt directly into the buffer of the encrypted bucket
+    encrypted_bucket = bytearray(NONCE_SIZE + TAG_SIZE + len(plaintext))
+    cipher.encrypt(plaintext, output=memoryview(encrypted_bucket)[NONCE_SIZE + TAG_SIZE:])
+    encrypted_bucket[:NONCE_SIZE] = nonce
+    encrypted_bucket[NONCE_SIZE:NONCE_SIZE + TAG_SIZE] = cipher.digest()
+    return encrypted_bucket
+
+
+def decrypt_bucket_ciphertext(secret_key: bytes, bucket_index: int, encrypted_bucket) -> bytearray:
+    """
+    return the plaintext of an encrypted bucket as returned from encrypt_bucket_plaintext.
+    raise ValueError if the bucket is missing or decryption or authentication didn't succeed
+    """
+    if encrypted_bucket is None:  # the server lost (or hides) a bucket that was written
+        raise ValueError(f'bucket {bucket_index} is missing')
+    encrypted_bucket = memoryview(encrypted_bucket)
+    cipher = AES.new(secret_key, AES.MODE_GCM, nonce=encrypted_bucket[:NONCE_SIZE])
+    cipher.update(bucket_index.to_bytes(INDEX_SIZE, 'big'))
+    plaintext = bytearray(len(encrypted_bucket) - NONCE_SIZE - TAG_SIZE)
+    cipher.decrypt(encrypted_bucket[NONCE_SIZE + TAG_SIZE:], output=plaintext)
+    cipher.verify(encrypted_bucket[NONCE_SIZE:NONCE_SIZE + TAG_SIZE])
+    return plaintext
+
+
+class Operations:
+    READ = 'read'
+    WRITE = 'write'
+    DELETE = 'delete'
+    UPDATE = 'update'
 
 
 class Client:
@@ -23,283 +96,662 @@ class Client:
     client should be able to encrypt/decrypt and authenticate the data
     """
 
-    def __init__(self, N: int, server: Server):
-        self.tree_height = max(0, math.ceil(math.log(N, 2)) - 1)  # it was proven that this is sufficient in 3.2
-        self.bucket_size = math.ceil(math.log(N, 2))
-        num_of_leaves = 2 ** self.tree_height
-        self.tree_size = (2 * num_of_leaves) - 1
-        self.leaves_indices = list(range(num_of_leaves - 1, self.tree_size))
+    def __init__(self, N: int, server: Server, bucket_size: int = DEFAULT_BUCKET_SIZE, data_size: int = DATA_SIZE,
+                 position_map=None, lazy_init: bool = False, treetop_levels: int = 0,
+                 treetop_memory_budget: int = None, crypto_pool: ParallelCrypto = None, metrics=DISABLED_METRICS):
+        """
+        :param N: number of data blocks supported
+        :param server: server object
+        :param bucket_size: number of blocks in each bucket (Z)
+        :param data_size: maximal size in bytes of the data of each block
+        :param position_map: position map to use (DictPositionMap by default, ArrayPositionMap for dense data ids
+         or RecursivePositionMap)
+        :param lazy_init: if True the tree is not filled with dummies in advance. a bucket that was never written
+         is read as an all-dummy bucket and gets real ciphertext the first time a path through it is written
+        :param treetop_levels: number of top tree levels (from the root) which are kept by the client in plaintext
+         instead of on the server. at least the leaves level is always kept on the server
+        :param treetop_memory_budget: if given, treetop_levels is the largest number of levels that fit in this
+         many bytes of client memory
+        :param crypto_pool: pool which encrypts / decrypts the buckets of a path in parallel (None - serially)
+        :param metrics: Metrics which count and time the phases of every access (disabled by default)
+        """
+        self.tree_height = get_tree_height(N)
+        self.bucket_size = bucket_size
+        self.data_size = data_size
+        self.block_size = get_block_size(data_size)
+        self.tree_size = get_tree_size(self.tree_height)
+        self.tree_index = TreeIndex(self.tree_height)
+        if treetop_memory_budget is not None:
+            treetop_levels = 0
+            while get_tree_size(treetop_levels) * bucket_size * self.block_size <= treetop_memory_budget:
+                treetop_levels += 1
+        self.treetop_levels = min(treetop_levels, self.tree_height)
+        self.treetop_size = (2 ** self.treetop_levels) - 1  # number of buckets in the treetop levels
+        # plaintext buckets of the treetop - list of (data_id, leaf_index, data) for every bucket index
+        self.treetop_buckets = [[] for _ in range(self.treetop_size)]
 
         self.num_of_files = N
-        self.position_map = dict()
+        self.position_map = position_map if position_map is not None else DictPositionMap()
+        # membership checks are free only for a map in client memory - a recursive map costs an access per level
+        self.position_map_in_memory = isinstance(self.position_map, (DictPositionMap, ArrayPositionMap))
+        # real blocks held by the client (data_id -> (leaf_index, data)) until they are evicted
+        self.stash = dict()
+        self.max_stash_size = 0  # largest stash size seen after an eviction
+        # server buckets whose write failed - the server may still hold their old contents (stale copies of
+        # blocks that are in the stash), so they are rewritten before the tree is read again
+        self.unwritten_buckets = set()
+        # data id -> leaf of its stale block, left in the tree by a lazy delete until a read of its path drops it
+        self.deleted_leaves = dict()
+        self.max_deleted_leaves = max(1, int(N * MAX_DELETED_LEAVES_FACTOR))
         self.secret_key = get_random_bytes(KEY_SIZE)
-        self.initialize_tree_with_dummies(server)
+        self.nonce_prefix = get_random_bytes(NONCE_PREFIX_SIZE)
+        self.nonce_counter = 0
+        self.crypto_pool = crypto_pool
+        self.metrics = metrics
+        # bitmap of the buckets which were written by the client (and so must hold an authentic ciphertext)
+        self.initialized_buckets = bytearray(-(-self.tree_size // 8))
+        if not lazy_init:
+            self.initialize_tree_with_dummies(server)
 
     def initialize_tree_with_dummies(self, server: Server):
         """
         fill the tree storge of the given server with dummy data
         """
-        for bucket_id in range(self.tree_size):
-            encrypted_bucket = [self.encrypt_data(DUMMY_ID, DUMMY_DATA) for _ in range(self.bucket_size)]
-            server.write_bucket_by_index(bucket_id, encrypted_bucket)
+        for level in range(self.treetop_levels, self.tree_height + 1):  # one server call per level
+            level_indices = get_node_indices_of_level(level)
+            encrypted_buckets = self.encrypt_packed_buckets(level_indices,
+                                                            [self.pack_bucket([]) for _ in level_indices])
+            server.write_buckets_by_indices(level_indices, encrypted_buckets)
+            self.metrics.increment('server_calls')
+            for bucket_id in level_indices:
+                self.set_bucket_initialized(bucket_id)
+
+    def is_bucket_initialized(self, bucket_index: int) -> bool:
+        """
+        return True if the bucket in the given index was already written by the client
+        """
+        return bool(self.initialized_buckets[bucket_index >> 3] & (1 << (bucket_index & 7)))
+
+    def set_bucket_initialized(self, bucket_index: int):
+        """
+        mark the bucket in the given index as written by the client
+        """
+        self.initialized_buckets[bucket_index >> 3] |= 1 << (bucket_index & 7)
 
     def read_path(self, leaf_index: int, server: Server):
         """
-        return the list of indices and buckets of the nodes from root to the given tree leaf
+        return the list of indices of the nodes from root to the given tree leaf, and the buckets of the nodes
+        below the treetop levels (the ones kept on the server)
         """
-        path_indices = get_path_to_leaf(leaf_index, self.tree_height)
-        path_buckets = server.get_buckets_by_indices(path_indices)
+        path_indices = self.tree_index.get_path(leaf_index)
+        with self.metrics.phase('read_path'):
+            path_buckets = server.read_path(leaf_index, self.treetop_levels)
+        self.metrics.increment('server_calls')
+        if self.metrics.enabled:  # bytes read before the requested block is known
+            self.metrics.increment('online_bytes', sum(len(bucket) for bucket in path_buckets if bucket is not None))
         return path_buckets, path_indices
 
-    def generate_new_leaf_index(self):
+    def move_buckets_to_stash(self, bucket_indices: List[int], encrypted_buckets: List[Union[bytes, None]]):
         """
-        return a random leaf index
+        move the real blocks of the given buckets to the stash - either the plaintext treetop buckets kept by the
+        client (their encrypted bucket is ignored) or the given encrypted buckets read from the server, which are
+        decrypted together (in parallel if the client has a crypto pool)
         """
-        return secrets.choice(self.leaves_indices)
-
-    def get_next_node_index_in_path_to_leaf(self, data_id: int, curr_bucket_index: int):
+        blocks_of_buckets = []
+        server_bucket_indices, server_buckets = [], []
+        for bucket_index, encrypted_bucket in zip(bucket_indices, encrypted_buckets):
+            if bucket_index < self.treetop_size:
+                blocks_of_buckets.append(self.treetop_buckets[bucket_index])
+                self.treetop_buckets[bucket_index] = []
+            elif self.is_bucket_initialized(bucket_index):  # buckets that were never written are all dummies
+                server_bucket_indices.append(bucket_index)
+                server_buckets.append(encrypted_bucket)
+        blocks_of_buckets.extend(self.decrypt_buckets(server_bucket_indices, server_buckets))
+        for blocks in blocks_of_buckets:
+            self.add_blocks_to_stash(blocks)
+
+    def add_blocks_to_stash(self, blocks: Iterable[Tuple[int, int, bytes]]):
         """
-        return the bucket of the next node of path from root to leaf of given data_id which stored in
-         the bucket curr_bucket_index
+        move the given real blocks (data_id, leaf_index, data) read from the tree to the stash. the stale block
+        of a lazily deleted data id is dropped instead, which frees its place in the tree
         """
-        if data_id == DUMMY_ID:  # if dummy id - return one of the bucket's children
-            left_child_index = get_left_child_index(curr_bucket_index)
-            right_child_index = get_right_child_index(curr_bucket_index)
-            return secrets.choice([left_child_index, right_child_index])
-
-        # if not a dummy id
-        leaf_index = self.position_map[data_id]
-        if leaf_index == curr_bucket_index:  # if curr bucket is leaf - no children
-            return leaf_index
-        path_indices = get_path_to_leaf(leaf_index, self.tree_height)
-        curr_index_in_path_list = path_indices.index(curr_bucket_index)
-        return path_indices[curr_index_in_path_list + 1]
-
-    def insert_data_to_bucket(self, encrypted_data, bucket, bucket_id: int, server: Server):
+        for data_id, leaf_index_of_data, data in blocks:
+            if self.deleted_leaves and self.deleted_leaves.get(data_id) == leaf_index_of_data:
+                del self.deleted_leaves[data_id]
+            else:
+                self.stash[data_id] = (leaf_index_of_data, data)
+
+    def seal_buckets(self, bucket_indices: List[int], blocks_of_buckets: List[List[Tuple[int, int, bytes]]]) \
+            -> List[bytearray]:
         """
-         insert the given data to the given bucket. (replace first dummy with given data)
-         decrypt and re-encrypt all bucket and write back to the server
+        keep the blocks of the treetop buckets in the client and return the encrypted buckets of the others
+        (in order) to write to the server. the buckets are encrypted together - in parallel if the client has
+        a crypto pool
         """
-        new_bucket = []
-        replaced_with_dummy = False
-        # traverse bucket to find a dummy data to replace with new data
-        for encrypted_block in bucket:
-            curr_data_id, curr_data = self.decrypt_data(encrypted_block)
-            if (not replaced_with_dummy) and (
-                    curr_data_id == DUMMY_ID):  # if found first dummy - replace with encrypted_data
-                new_bucket.append(encrypted_data)
-                replaced_with_dummy = True
-            else:  # if not searched data - just re-encrypt again
-                re_encrypt_data = self.encrypt_data(curr_data_id, curr_data)
-                new_bucket.append(re_encrypt_data)
-
-        # write re_encrypted root bucket with added data back to the server
-        server.write_bucket_by_index(bucket_id, new_bucket)
+        server_bucket_indices, plaintexts = [], []
+        for bucket_index, blocks in zip(bucket_indices, blocks_of_buckets):
+            if bucket_index < self.treetop_size:
+                self.treetop_buckets[bucket_index] = blocks
+            else:
+                server_bucket_indices.append(bucket_index)
+                plaintexts.append(self.pack_bucket(blocks))
+        return self.encrypt_packed_buckets(server_bucket_indices, plaintexts)
 
-    def remove_data_from_bucket(self, data_id_to_remove: int, bucket, bucket_index: int,
-                                server: Server, still_remove: bool):
+    def generate_new_leaf_index(self):
         """
-         remove the given data from the given bucket. (replace with dummy)
-         decrypt and re-encrypt all bucket and write back to the server
+        return a random leaf index
         """
-        searched_data = None
-        re_encrypt_bucket = []
-        for encrypted_data_block in bucket:
-            data_id, data = self.decrypt_data(encrypted_data_block)
-
-            # check if still not found and this is searched data
-            if still_remove and (data_id == data_id_to_remove):
-                searched_data = data
-                # if data found, it should be removed from bucket - so write dummy instead
-                re_encrypted_data = self.encrypt_data(DUMMY_ID, DUMMY_DATA)
-
-            else:  # if not searched data - just re-encrypt again
-                re_encrypted_data = self.encrypt_data(data_id, data)
-
-            re_encrypt_bucket.append(re_encrypted_data)  # add encrypted data to new bucket
-
-        server.write_bucket_by_index(bucket_index,
-                                     re_encrypt_bucket)  # write back full re-encrypted bucket to server
+        return self.tree_index.generate_random_leaf()
 
-        return searched_data
+    def get_leaf_of_unmapped(self, data_id: int) -> int:
+        """
+        return the leaf whose path is read by an access to a data id which is not in the position map - the leaf
+        of its stale block if it was lazily deleted (so the stale block is dropped before the id is stored
+        again), otherwise a random leaf
+        """
+        leaf_index = self.deleted_leaves.get(data_id)
+        return leaf_index if leaf_index is not None else self.generate_new_leaf_index()
 
-    def prevent_overflow(self, server: Server):
+    def read_path_to_stash(self, leaf_index: int, server: Server) -> List[int]:
         """
-        prevent from overflows in the tree according to the algorithm shown here https://youtu.be/3RWyVGwG9U8?t=2792
+        read the path from root to the given leaf, decrypt every bucket on it and move all the real
+        blocks to the stash. return the indices of the nodes in the path
         """
-        for level in range(self.tree_height):  # for each level apart from leaves
-            if level == ROOT_INDEX:  # if root level - there is only one bucket so choose only root
-                curr_chosen_bucktes_indices = [ROOT_INDEX]
+        self.write_unwritten_buckets(server)
+        path_buckets, path_indices = self.read_path(leaf_index, server)
+        self.move_buckets_to_stash(path_indices, [None] * self.treetop_levels + path_buckets)
+        return path_indices
 
-            else:  # other levels have at least 2 buckets
-                curr_level_indices = get_node_indices_of_level(level)
-                curr_chosen_bucktes_indices = random.sample(curr_level_indices, 2)
+    def evict_to_path(self, leaf_index: int) -> List[List[Tuple[int, int, bytes]]]:
+        """
+        greedily take blocks from the stash for every bucket on the path of the given leaf (deepest bucket first) -
+        up to bucket_size blocks whose own path goes through the bucket. return the blocks of every bucket from
+        root to leaf. blocks that do not fit stay in the stash
+        """
+        # group the stash blocks by the deepest level their path shares with the written path
+        blocks_by_level = [[] for _ in range(self.tree_height + 1)]
+        for data_id, (leaf_index_of_data, _) in self.stash.items():
+            level = get_deepest_common_level(leaf_index_of_data, leaf_index, self.tree_height)
+            blocks_by_level[level].append(data_id)
+
+        candidates = []  # blocks that may be placed in the current bucket
+        blocks_of_buckets = [None] * (self.tree_height + 1)
+        for level in range(self.tree_height, -1, -1):  # from leaf to root
+            candidates.extend(blocks_by_level[level])
+            new_bucket = []
+            while candidates and len(new_bucket) < self.bucket_size:
+                data_id = candidates.pop()
+                new_bucket.append((data_id, *self.stash.pop(data_id)))
+
+            blocks_of_buckets[level] = new_bucket
+        return blocks_of_buckets
+
+    def write_path_from_stash(self, leaf_index: int, path_indices: List[int], server: Server):
+        """
+        greedily evict blocks from the stash back to the path of the given leaf (see evict_to_path) and re-encrypt
+        every bucket (padded with dummies). the whole path below the treetop is written back to the server in one
+        call. blocks that do not fit stay in the stash. if the write fails, its blocks are returned to the stash
+        (see restore_unwritten_blocks) and the error is raised
+        """
+        with self.metrics.phase('evict'):
+            blocks_of_buckets = self.evict_to_path(leaf_index)
+        try:
+            encrypted_buckets = self.seal_buckets(path_indices, blocks_of_buckets)
+            with self.metrics.phase('write_path'):
+                server.write_path(leaf_index, encrypted_buckets, self.treetop_levels)
+        except Exception:
+            self.restore_unwritten_blocks(path_indices, blocks_of_buckets)
+            raise
+        self.metrics.increment('server_calls')
+        for bucket_index in path_indices:
+            self.set_bucket_initialized(bucket_index)
+        self.update_stash_metrics()
+
+    def update_stash_metrics(self):
+        """
+        record the stash size after an eviction
+        """
+        self.max_stash_size = max(self.max_stash_size, len(self.stash))
+        self.metrics.observe('stash_size', len(self.stash))
 
-            curr_chosen_bucktes = server.get_buckets_by_indices(curr_chosen_bucktes_indices)
-            for bucket_index, bucket in zip(curr_chosen_bucktes_indices,
-                                            curr_chosen_bucktes):  # for each of the chosen buckets
-                data_to_push_down = None
-                data_id_to_push_down = None
-                index_to_push_down = random.randint(0,
-                                                    self.bucket_size - 1)  # choose one data in file to push down
-                new_bucket = []
-                for index, encrypted_block in enumerate(bucket):  # for each data in bucket
-                    curr_data_id, curr_data = self.decrypt_data(encrypted_block)
+    def read_paths_to_stash(self, leaf_indices: List[int], server: Server) -> List[int]:
+        """
+        read the paths from root to all the given leaves in a single server call (buckets shared by several paths
+        are read once, treetop buckets are not read from the server), decrypt them and move all the real blocks to
+        the stash. return the sorted indices of the buckets that were read
+        """
+        self.write_unwritten_buckets(server)
+        bucket_indices = self.tree_index.get_union_of_paths(leaf_indices)
+        server_bucket_indices = [bucket_index for bucket_index in bucket_indices if bucket_index >= self.treetop_size]
+        with self.metrics.phase('read_path'):
+            buckets = server.get_buckets_by_indices(server_bucket_indices)
+        self.metrics.increment('server_calls')
+        if self.metrics.enabled:
+            self.metrics.increment('online_bytes', sum(len(bucket) for bucket in buckets if bucket is not None))
+        # the treetop buckets have the smallest indices, so they come first
+        self.move_buckets_to_stash(bucket_indices, [None] * (len(bucket_indices) - len(buckets)) + buckets)
+        return bucket_indices
+
+    def evict_to_buckets(self, bucket_indices: List[int]) -> Dict[int, List[Tuple[int, int, bytes]]]:
+        """
+        greedily take blocks from the stash for the given buckets (the union of some paths), deepest buckets first.
+        return the blocks of every bucket index
+        """
+        buckets_by_level = [[] for _ in range(self.tree_height + 1)]
+        for bucket_index in bucket_indices:
+            buckets_by_level[get_level_of_node(bucket_index)].append(bucket_index)
+
+        new_buckets = dict()
+        for level in range(self.tree_height, -1, -1):  # from leaves to root
+            if not buckets_by_level[level]:
+                continue
+            # candidates of each bucket of the level - blocks whose own path goes through it
+            candidates = {bucket_index: [] for bucket_index in buckets_by_level[level]}
+            for data_id, (leaf_index_of_data, _) in self.stash.items():
+                ancestor_index = self.tree_index.get_ancestor(leaf_index_of_data, level)
+                if ancestor_index in candidates:
+                    candidates[ancestor_index].append(data_id)
+
+            for bucket_index, bucket_candidates in candidates.items():
+                new_bucket = [(data_id, *self.stash.pop(data_id))
+                              for data_id in bucket_candidates[:self.bucket_size]]
+                new_buckets[bucket_index] = new_bucket
+        return new_buckets
+
+    def write_paths_from_stash(self, bucket_indices: List[int], server: Server):
+        """
+        greedily evict blocks from the stash to the given buckets (the union of some paths, as returned from
+        read_paths_to_stash), deepest buckets first, and write them all back in a single server call. if the write
+        fails, its blocks are returned to the stash (see restore_unwritten_blocks) and the error is raised
+        """
+        with self.metrics.phase('evict'):
+            new_buckets = self.evict_to_buckets(bucket_indices)
+        blocks_of_buckets = [new_buckets[bucket_index] for bucket_index in bucket_indices]
+        server_bucket_indices = [bucket_index for bucket_index in bucket_indices if bucket_index >= self.treetop_size]
+        try:
+            encrypted_buckets = self.seal_buckets(bucket_indices, blocks_of_buckets)
+            with self.metrics.phase('write_path'):
+                server.write_buckets_by_indices(server_bucket_indices, encrypted_buckets)
+        except Exception:
+            self.restore_unwritten_blocks(bucket_indices, blocks_of_buckets)
+            raise
+        self.metrics.increment('server_calls')
+        for bucket_index in bucket_indices:
+            self.set_bucket_initialized(bucket_index)
+        self.update_stash_metrics()
+
+    def restore_unwritten_blocks(self, bucket_indices: List[int],
+                                 blocks_of_buckets: List[List[Tuple[int, int, bytes]]]):
+        """
+        move the blocks evicted to the server buckets of a failed write back to the stash, and keep the buckets
+        in unwritten_buckets (the treetop buckets are kept by the client, so their blocks are not returned).
+        note that a write which timed out may still be applied by the server later - if that happens after the
+        buckets are rewritten, it overwrites them with older contents
+        """
+        for bucket_index, blocks in zip(bucket_indices, blocks_of_buckets):
+            if bucket_index >= self.treetop_size:
+                for data_id, leaf_index_of_data, data in blocks:
+                    self.stash[data_id] = (leaf_index_of_data, data)
+                self.unwritten_buckets.add(bucket_index)
 
-                    if index == index_to_push_down:  # the data to push down - replace with dummy
-                        data_to_push_down = curr_data
-                        data_id_to_push_down = curr_data_id
-                        re_encrypted_data = self.encrypt_data(DUMMY_ID, DUMMY_DATA)
-                    else:  # not data to push down
-                        re_encrypted_data = self.encrypt_data(curr_data_id, curr_data)
+    def write_unwritten_buckets(self, server: Server):
+        """
+        evict the stash to the buckets whose write failed and write them (one server call, only after a failure)
+        """
+        if self.unwritten_buckets:
+            self.write_paths_from_stash(sorted(self.unwritten_buckets), server)
+            self.unwritten_buckets.clear()
 
-                    new_bucket.append(re_encrypted_data)
+    def access(self, server: Server, operation: str, data_id: int,
+               new_data: Union[bytes, Callable] = None) -> Union[bytes, None]:
+        """
+        single Path ORAM access: assign the data a new random leaf, read the whole path of its old leaf into
+        the stash, perform the operation on the stash and write the same path back.
+        if the data id is not stored yet a random path is read, so all accesses look the same. the path is written
+        back even if the function of an UPDATE raises (the block is kept unchanged and the error is raised).
+        if a server call fails the error is raised and no block is lost - the operation is not performed if the read
+        failed, and is kept in the stash if the write failed
+        :param server: server object
+        :param operation: one of Operations
+        :param data_id: int of data id
+        :param new_data: data to write for Operations.WRITE, or a function from the current data (None if there
+         is no such data) to the new data for Operations.UPDATE
+        :return: the data stored with the given id before the operation, None if there was no such data
+        """
+        with self.metrics.phase('access'):
+            new_leaf_index = self.generate_new_leaf_index()
+            with self.metrics.phase('position_map'):
+                if operation == Operations.DELETE:
+                    leaf_index = self.position_map.pop(data_id, None)
+                elif operation == Operations.READ:  # a read of a data id which is not stored does not map it
+                    leaf_index = self.position_map.remap_existing(data_id, new_leaf_index)
+                else:
+                    leaf_index = self.position_map.remap(data_id, new_leaf_index)
+            mapped_leaf_index = leaf_index
+            if leaf_index is None:  # data is not stored - read a random path
+                leaf_index = self.get_leaf_of_unmapped(data_id)
+            try:
+                path_indices = self.read_path_to_stash(leaf_index, server)
+            except Exception:  # the block is still on the path of its old leaf
+                if mapped_leaf_index is not None:
+                    self.position_map[data_id] = mapped_leaf_index
+                else:
+                    self.position_map.pop(data_id, None)
+                raise
+            try:
+                data = self.apply_operation(operation, data_id, new_data, new_leaf_index)
+            finally:
+                if operation in (Operations.WRITE, Operations.UPDATE) and data_id not in self.stash:  # no block
+                    self.position_map.pop(data_id, None)
+                self.write_path_from_stash(leaf_index, path_indices, server)
+        self.metrics.increment(f'{operation}_accesses')
+        return data
+
+    def dummy_access(self, server: Server):
+        """
+        read a random path to the stash and write it back - looks the same to the server as any other access
+        """
+        with self.metrics.phase('access'):
+            leaf_index = self.generate_new_leaf_index()
+            path_indices = self.read_path_to_stash(leaf_index, server)
+            self.write_path_from_stash(leaf_index, path_indices, server)
 
-                server.write_bucket_by_index(bucket_index, new_bucket)
-
-                # encrypted elements to push down
-                encrypted_push_down = self.encrypt_data(data_id_to_push_down, data_to_push_down)
-                encrypted_dummy = self.encrypt_data(DUMMY_ID, DUMMY_DATA)
-
-                # indices and buckets of left and right children
-                next_node_index_to_leaf = self.get_next_node_index_in_path_to_leaf(data_id_to_push_down,
-                                                                                   bucket_index)
-                left_child_index = get_left_child_index(bucket_index)
-                right_child_index = get_right_child_index(bucket_index)
-                left_bucket = server.get_bucket_by_index(left_child_index)
-                right_bucket = server.get_bucket_by_index(right_child_index)
-
-                if next_node_index_to_leaf == left_child_index:  # need to push data to left child - write dummy to right
-                    self.insert_data_to_bucket(encrypted_push_down, left_bucket, left_child_index, server)
-                    self.insert_data_to_bucket(encrypted_dummy, right_bucket, right_child_index, server)
-
-                else:  # need to push data to right child - write dummy to left
-                    self.insert_data_to_bucket(encrypted_dummy, left_bucket, left_child_index, server)
-                    self.insert_data_to_bucket(encrypted_push_down, right_bucket, right_child_index, server)
+    def apply_operation(self, operation: str, data_id: int, new_data: Union[bytes, Callable],
+                        new_leaf_index: int) -> Union[bytes, None]:
+        """
+        perform the operation on the block of the given data id in the stash (its path must have been read to
+        the stash already). the block that is kept is assigned new_leaf_index. if the function of an UPDATE
+        raises, the block is kept unchanged (with new_leaf_index) and the error is raised
+        :return: the data stored with the given id before the operation, None if there was no such data
+        """
+        _, data = self.stash.get(data_id, (None, None))
+        update_error = None
+        if operation == Operations.READ:
+            updated_data = data
+        elif operation == Operations.WRITE:
+            updated_data = new_data
+        elif operation == Operations.UPDATE:
+            try:
+                updated_data = new_data(data)
+            except Exception as e:
+                updated_data, update_error = data, e
+        else:  # Operations.DELETE
+            updated_data = None
+        if updated_data is None:
+            self.stash.pop(data_id, None)
+        else:
+            self.stash[data_id] = (new_leaf_index, updated_data)
+        if update_error is not None:
+            raise update_error
+        return data
 
     # __________________ Encrypt-Decrypt data __________________
 
-    def encrypt_data(self, data_id, data: str):
+    def generate_nonce(self) -> bytes:
         """
-        encrypt data
-        :param data_id: int of data id
-        :param data: data to encrypt
-        :return: encrypted data (encryption of nonce + tag + ciphertext)
+        return a new unique nonce - a random prefix chosen once per client followed by a counter which
+        is advanced for every encrypted bucket, so a (key, nonce) pair is never reused
         """
-        cipher = AES.new(self.secret_key, AES.MODE_EAX)
+        self.nonce_counter += 1
+        return self.nonce_prefix + self.nonce_counter.to_bytes(NONCE_SIZE - NONCE_PREFIX_SIZE, 'big')
 
-        # convert data (str) to bytes
-        data_parts = str(data_id) + data
-        data_parts_in_bytes = str.encode(data_parts)
+    def crypto_map(self, function: Callable, *iterables) -> List:
+        """
+        return the results of the function on every item of the iterables, using the crypto pool if there is one
+        """
+        if self.crypto_pool is None:
+            return list(map(function, *iterables))
+        return self.crypto_pool.map(function, *iterables)
 
-        # encrypt
-        ciphertext_in_bytes, tag_in_bytes = cipher.encrypt_and_digest(data_parts_in_bytes)
-        nonce_in_bytes = cipher.nonce
-        return nonce_in_bytes + tag_in_bytes + ciphertext_in_bytes
+    def pack_bucket(self, blocks: List[Tuple[int, int, bytes]]) -> bytearray:
+        """
+        return the plaintext of a bucket of the given real blocks (data_id, leaf_index, data), padded with dummy
+        blocks to bucket_size blocks
+        """
+        plaintext = bytearray(self.bucket_size * self.block_size)  # all zeros - dummy blocks
+        for block_number, (data_id, leaf_index, data) in enumerate(blocks):
+            pack_block_into(plaintext, block_number * self.block_size, data_id, leaf_index, data)
+        return plaintext
 
-    def decrypt_data(self, data):
+    def encrypt_bucket(self, bucket_index: int, blocks: List[Tuple[int, int, bytes]]) -> bytearray:
         """
-        return decrypted data of given data.
-        can raise ValueError or KeyError if decryption or authentication didn't succeed
-        :param data: encrypted data
+        encrypt a whole bucket as a single AES-GCM ciphertext. the bucket is padded with dummy blocks to
+        bucket_size blocks and the bucket index is authenticated so the server can not swap buckets
+        :param bucket_index: index of the bucket in the tree
+        :param blocks: list of (data_id, leaf_index, data) of the real blocks in the bucket
+        :return: encrypted bucket (nonce + tag + ciphertext)
         """
-        nonce_in_bytes, tag_in_bytes, ciphertext_in_bytes = \
-            data[:NONCE_TAG_SIZE], data[NONCE_TAG_SIZE:2 * NONCE_TAG_SIZE], data[2 * NONCE_TAG_SIZE:]
-        cipher = AES.new(self.secret_key, AES.MODE_EAX, nonce_in_bytes)
+        return self.encrypt_packed_buckets([bucket_index], [self.pack_bucket(blocks)])[0]
 
+    def encrypt_packed_buckets(self, bucket_indices: List[int], plaintexts: List[bytearray]) -> List[bytearray]:
+        """
+        encrypt buckets whose real blocks are already packed by pack_block_into(). every bucket is padded with
+        dummy blocks to bucket_size blocks (the given plaintexts are extended in place). the nonces are generated
+        here, so only the encryption itself runs in the crypto pool
+        :param bucket_indices: index of every bucket in the tree
+        :param plaintexts: packed real blocks of every bucket
+        :return: encrypted buckets (nonce + tag + ciphertext)
+        """
+        bucket_size_in_bytes = self.bucket_size * self.block_size
+        for plaintext in plaintexts:
+            plaintext += bytes(bucket_size_in_bytes - len(plaintext))
+        nonces = [self.generate_nonce() for _ in bucket_indices]
+        with self.metrics.phase('encrypt'):
+            encrypted_buckets = self.crypto_map(encrypt_bucket_plaintext, [self.secret_key] * len(nonces), nonces,
+                                                bucket_indices, plaintexts)
+        self.metrics.increment('encryptions', len(encrypted_buckets))
+        return encrypted_buckets
+
+    def decrypt_bucket(self, bucket_index: int, encrypted_bucket: bytes) -> List[Tuple[int, int, memoryview]]:
+        """
+        return the real blocks (data_id, leaf_index, data) of the given encrypted bucket, dummy blocks are dropped.
+        the data of every block is a zero-copy memoryview of the decrypted bucket.
+        raise ValueError if decryption or authentication didn't succeed
+        :param bucket_index: index of the bucket in the tree
+        :param encrypted_bucket: encrypted bucket as returned from encrypt_bucket
+        """
+        return self.decrypt_buckets([bucket_index], [encrypted_bucket])[0]
+
+    def decrypt_buckets(self, bucket_indices: List[int], encrypted_buckets: List[bytes]) \
+            -> List[List[Tuple[int, int, memoryview]]]:
+        """
+        return the real blocks of every given encrypted bucket (see decrypt_bucket), decrypted in the crypto pool.
+        raise ValueError if decryption or authentication of any bucket didn't succeed
+        """
         try:
-            plaintext_in_bytes = cipher.decrypt_and_verify(ciphertext_in_bytes, tag_in_bytes)
-            plaintext = bytes.decode(plaintext_in_bytes)
-            if plaintext[:-DATA_SIZE].isnumeric():  # if id is a number - not dummy data
-                data_id, data = int(plaintext[:-DATA_SIZE]), plaintext[-DATA_SIZE:]
-            else:  # if id is not a number - dummy data
-                data_id, data = plaintext[:-DATA_SIZE], plaintext[-DATA_SIZE:]
-            return data_id, data
-        except (ValueError, KeyError):
+            with self.metrics.phase('decrypt'):
+                plaintexts = self.crypto_map(decrypt_bucket_ciphertext, [self.secret_key] * len(bucket_indices),
+                                             bucket_indices, encrypted_buckets)
+        except ValueError as e:
+            self.metrics.record_error('decryption', e)
             print("Incorrect decryption")
+            raise
+        self.metrics.increment('decryptions', len(plaintexts))
+        return [self.unpack_bucket(plaintext) for plaintext in plaintexts]
+
+    def unpack_bucket(self, plaintext: bytearray) -> List[Tuple[int, int, memoryview]]:
+        """
+        return the real blocks (data_id, leaf_index, data) packed in the given bucket plaintext. the data of
+        every block is a zero-copy memoryview of the plaintext
+        """
+        plaintext_view = memoryview(plaintext)
+        blocks = []
+        for block_offset in range(0, len(plaintext), self.block_size):
+            is_real, data_id, leaf_index, data_length = struct.unpack_from(BLOCK_HEADER_FORMAT, plaintext,
+                                                                          block_offset)
+            if is_real:
+                data_offset = block_offset + BLOCK_HEADER_SIZE
+                blocks.append((data_id, leaf_index, plaintext_view[data_offset:data_offset + data_length]))
+        return blocks
 
     # __________________ API methods __________________
 
-    def store_date(self, server: Server, data_id: int, data: str) -> None:
+    def get_data_in_bytes(self, data: Union[str, bytes]) -> Union[bytes, None]:
         """
-        write data to root bucket. decrypt root bucket and find a dummy data to replace with given data.
-        assign new random leaf to data and store in position_map.
-        call prevent_overflow() to make sure root will not be full of real data
+        return the given data as bytes (strings are utf-8 encoded), None if it is longer than data_size bytes
+        """
+        data_in_bytes = str.encode(data) if isinstance(data, str) else data
+        if len(data_in_bytes) > self.data_size:
+            return None
+        return data_in_bytes
+
+    def store_date(self, server: Server, data_id: int, data: Union[str, bytes]) -> None:
+        """
+        store new data. the data is inserted to the stash with a new random leaf and evicted to the tree
+        as part of a single path access
         :param server: server object
         :param data_id: int of data id
-        :param data: data to store
+        :param data: data to store - string or bytes-like of at most data_size bytes
         """
-        if data_id in self.position_map:
+        if self.position_map_in_memory and data_id in self.position_map:
             print(color_text('Error: data_id is already in use. choose a different one', Colors.RED))
             return
 
-        if len(data) != DATA_SIZE:
-            print(color_text(f'Error: data must be string of {DATA_SIZE} characters', Colors.RED))
+        data_in_bytes = self.get_data_in_bytes(data)
+        if data_in_bytes is None:
+            print(color_text(f'Error: data must be at most {self.data_size} bytes', Colors.RED))
             return
 
-        encrypted_data = self.encrypt_data(data_id, data)
-
-        root_bucket = server.get_bucket_by_index(ROOT_INDEX)
-        self.insert_data_to_bucket(encrypted_data, root_bucket, ROOT_INDEX, server)
-
-        # assign new random leaf to data and save in position map
-        self.position_map[data_id] = self.generate_new_leaf_index()
-        # move data blocks down the tree to prevent overflows
-        self.prevent_overflow(server)
+        if self.position_map_in_memory:
+            self.access(server, Operations.WRITE, data_id, data_in_bytes)
+        # a recursive map is checked by the access itself - the stored data is kept if the id is in use
+        elif self.access(server, Operations.UPDATE, data_id,
+                         lambda old_data: data_in_bytes if old_data is None else old_data) is not None:
+            print(color_text('Error: data_id is already in use. choose a different one', Colors.RED))
 
-    def retrieve_data(self, server: Server, requested_data_id: int) -> Union[str, None]:
+    def retrieve_bytes(self, server: Server, requested_data_id: int) -> Union[memoryview, None]:
         """
-        get data by id. search the correct path from root to leaf of given data by its id.
-        call store_data() to write the requested data back to the root
+        get data by id as bytes. read the path of the data to the stash, remap the data to a new random leaf
+        and write the path back
         :param server: server object
         :param requested_data_id: int of data id to find
-        :return: requested data. can raise ValueError or KeyError if decryption or authentication didn't succeed
+        :return: requested data (zero-copy view of the decrypted block), None if there is no such data.
+         can raise ValueError if decryption or authentication didn't succeed
         """
-        if requested_data_id not in self.position_map:
+        if self.position_map_in_memory and requested_data_id not in self.position_map:
             return None
-        leaf_of_data = self.position_map[requested_data_id]
-        path_buckets, path_indices = self.read_path(leaf_of_data, server)
+        return self.access(server, Operations.READ, requested_data_id)
 
-        # from now, it is guarantied that searched data is in the path from root to leaf
+    def retrieve_data(self, server: Server, requested_data_id: int) -> Union[str, None]:
+        """
+        get data by id as a string (see retrieve_bytes)
+        :param server: server object
+        :param requested_data_id: int of data id to find
+        :return: requested data. can raise ValueError if decryption or authentication didn't succeed
+        """
+        data = self.retrieve_bytes(server, requested_data_id)
+        return None if data is None else str(data, 'utf-8')
 
-        # traverse path from root to leaf and look for the searched data
-        searched_data = None
-        for bucket_index, bucket in zip(path_indices, path_buckets):
-            still_searching = searched_data is None
-            removed_data = self.remove_data_from_bucket(requested_data_id, bucket, bucket_index, server,
-                                                        still_searching)
-            if still_searching:
-                searched_data = removed_data
+    def bulk_load(self, server: Server, items: Iterable[Tuple[int, Union[str, bytes]]]) -> int:
+        """
+        build the initial tree from a dataset in one pass, instead of calling store_date() for every item.
+        every item gets a random leaf and is placed directly in the deepest bucket on its path that has space
+        (or in the stash if the whole path is full). then every bucket is encrypted and written exactly once,
+        one tree level per server call. items are consumed one at a time and kept only as packed blocks
+        :param server: server object
+        :param items: iterable of (data_id, data)
+        :return: number of items loaded
+        """
+        if len(self.position_map) > 0 or self.stash:
+            print(color_text('Error: bulk load is supported only for an empty storage', Colors.RED))
+            return 0
+
+        bucket_capacity = self.bucket_size * self.block_size
+        packed_buckets = [bytearray() for _ in range(self.tree_size)]
+        num_of_items = 0
+        for data_id, data in items:
+            data_in_bytes = self.get_data_in_bytes(data)
+            if data_id in self.position_map or data_in_bytes is None:
+                print(color_text(f'Error: skipping data id {data_id} - already in use or data is longer than '
+                                 f'{self.data_size} bytes', Colors.RED))
+                continue
+
+            leaf_index = self.generate_new_leaf_index()
+            self.position_map[data_id] = leaf_index
+            num_of_items += 1
+
+            bucket_index = leaf_index  # find the deepest bucket on the path with space
+            while len(packed_buckets[bucket_index]) == bucket_capacity and bucket_index != ROOT_INDEX:
+                bucket_index = get_parent_index(bucket_index)
+            if len(packed_buckets[bucket_index]) == bucket_capacity:  # whole path is full
+                self.stash[data_id] = (leaf_index, data_in_bytes)
+            else:
+                packed_bucket = packed_buckets[bucket_index]
+                block_offset = len(packed_bucket)
+                packed_bucket += bytes(self.block_size)
+                pack_block_into(packed_bucket, block_offset, data_id, leaf_index, data_in_bytes)
+
+        for level in range(self.tree_height + 1):  # one server call per level
+            level_indices = get_node_indices_of_level(level)
+            if level < self.treetop_levels:
+                for bucket_id in level_indices:
+                    self.treetop_buckets[bucket_id] = self.unpack_bucket(packed_buckets[bucket_id])
+            else:
+                encrypted_buckets = self.encrypt_packed_buckets(
+                    level_indices, [packed_buckets[bucket_id] for bucket_id in level_indices])
+                server.write_buckets_by_indices(level_indices, encrypted_buckets)
+                self.metrics.increment('server_calls')
+            for bucket_id in level_indices:
+                packed_buckets[bucket_id] = None
+                self.set_bucket_initialized(bucket_id)
+        self.deleted_leaves.clear()  # the stale blocks of lazy deletes were overwritten
+
+        self.update_stash_metrics()
+        return num_of_items
+
+    def update_data(self, server: Server, data_id: int, new_data: Union[str, bytes, Callable]) \
+            -> Union[memoryview, None]:
+        """
+        replace the data of an existing data id in a single access - the block is read to the stash, changed
+        there and evicted with the new leaf, instead of a retrieve followed by a delete and a store
+        :param server: server object
+        :param data_id: int of data id to update
+        :param new_data: new data (string or bytes-like of at most data_size bytes), or a function from the
+         current data to the new data (read-modify-write)
+        :return: the data before the update (zero-copy view of the decrypted block), None if there is no such data.
+         can raise ValueError if decryption or authentication didn't succeed
+        """
+        if self.position_map_in_memory and data_id not in self.position_map:
+            print(color_text('Error: given data_id does not exist in server. choose a different one', Colors.RED))
+            return None
 
-        # now data is not in storage so delete its id from position map
-        self.position_map.pop(requested_data_id)
-        # write searched data to root, assign new random leaf to data and prevent overflow
-        self.store_date(server, requested_data_id, searched_data)
+        def update_block(data):
+            if data is None:
+                return None
+            data_in_bytes = self.get_data_in_bytes(new_data(data) if callable(new_data) else new_data)
+            if data_in_bytes is None:  # the data is kept
+                print(color_text(f'Error: data must be at most {self.data_size} bytes', Colors.RED))
+                return data
+            return data_in_bytes
 
-        return searched_data
+        data = self.access(server, Operations.UPDATE, data_id, update_block)
+        if data is None:
+            print(color_text('Error: given data_id does not exist in server. choose a different one', Colors.RED))
+        return data
 
     def delete_data(self, server: Server, data_id_to_delete: int) -> None:
         """
-        delete the data associated with the given data id and remove the id from position_map
+        delete the data associated with the given data id and remove the id from position_map.
+        with an in-memory position map the delete is lazy: the id is dropped from position_map and the stash and
+        a dummy access is made, so the server sees a normal access. the stale block stays in the tree until a read
+        of its path drops it (or the id is stored again), and the client keeps its leaf meanwhile. with a recursive
+        position map, or when max_deleted_leaves stale blocks are pending, the block is removed by a normal access
         :param server: server object
         :param data_id_to_delete: int of data id to delete from the storage in the server
         :return: None
         """
-        if data_id_to_delete not in self.position_map:
+        if self.position_map_in_memory and data_id_to_delete not in self.position_map:
             print(color_text('Error: given data_id does not exist in server. choose a different one',
                              Colors.RED))
             return
-        leaf_of_data = self.position_map[data_id_to_delete]
-        path_buckets, path_indices = self.read_path(leaf_of_data, server)
-
-        # traverse path from root to leaf and look for the searched data
-        searched_data = None
-        for bucket_index, bucket in zip(path_indices, path_buckets):
-            still_searching = searched_data is None
-            removed_data = self.remove_data_from_bucket(data_id_to_delete, bucket, bucket_index, server,
-                                                        still_searching)
-            if still_searching:
-                searched_data = removed_data
-
-        # now data is not in storage so delete its id from position map
-        self.position_map.pop(data_id_to_delete)
+        if not self.position_map_in_memory or len(self.deleted_leaves) >= self.max_deleted_leaves:
+            if self.access(server, Operations.DELETE, data_id_to_delete) is None:  # the access checks the id
+                print(color_text('Error: given data_id does not exist in server. choose a different one',
+                                 Colors.RED))
+            return
+
+        leaf_index = self.position_map.pop(data_id_to_delete)
+        if self.stash.pop(data_id_to_delete, None) is None:  # the block is in the tree
+            self.deleted_leaves[data_id_to_delete] = leaf_index
+        self.dummy_access(server)
+        self.metrics.increment(f'{Operations.DELETE}_accesses')
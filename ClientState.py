@@ -0,0 +1,233 @@
+# Jonathan Birnbaum
+
+import hashlib
+import os
+import struct
+import sys
+from array import array
+from typing import Union
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from Client import Client, KEY_SIZE, NONCE_PREFIX_SIZE, NONCE_SIZE, TAG_SIZE
+from Metrics import DISABLED_METRICS
+from PositionMap import ArrayPositionMap, DictPositionMap
+from RingClient import RingClient
+
+STATE_MAGIC = b'ORAMSTAT'
+STATE_VERSION = 1
+SALT_SIZE = 16
+# magic, version, scrypt salt, nonce. authenticated with the encrypted state
+STATE_HEADER_FORMAT = f'>8sH{SALT_SIZE}s{NONCE_SIZE}s'
+STATE_HEADER_SIZE = struct.calcsize(STATE_HEADER_FORMAT)
+# number of data blocks, bucket size, data size, treetop levels, nonce counter, max stash size
+GEOMETRY_FORMAT = '>QIIIQQ'
+COUNT_FORMAT = '>Q'
+BLOCK_FORMAT = '>qqI'  # data id, leaf index, data length. followed by the data
+PAIR_FORMAT = '>qq'  # data id, leaf index
+DICT_POSITION_MAP = 0
+ARRAY_POSITION_MAP = 1
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def derive_state_key(user_key: Union[str, bytes], salt: bytes) -> bytes:
+    """
+    return the key which encrypts a snapshot, derived from the user key (passphrase or key bytes) with scrypt
+    """
+    if isinstance(user_key, str):
+        user_key = user_key.encode('utf-8')
+    return hashlib.scrypt(user_key, salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=KEY_SIZE)
+
+
+class StateWriter:
+    """
+    appends the binary fields of a snapshot to a buffer
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def pack(self, struct_format: str, *values):
+        self.buffer += struct.pack(struct_format, *values)
+
+    def write_bytes(self, data):
+        self.pack(COUNT_FORMAT, len(data))
+        self.buffer += data
+
+    def write_blocks(self, blocks):
+        self.pack(COUNT_FORMAT, len(blocks))
+        for data_id, leaf_index, data in blocks:
+            self.pack(BLOCK_FORMAT, data_id, leaf_index, len(data))
+            self.buffer += data
+
+    def write_pairs(self, items):
+        self.pack(COUNT_FORMAT, len(items))
+        for data_id, leaf_index in items:
+            self.pack(PAIR_FORMAT, data_id, leaf_index)
+
+
+class StateReader:
+    """
+    reads the binary fields of a snapshot in order (zero-copy memoryview slices of the plaintext)
+    """
+
+    def __init__(self, plaintext: bytearray):
+        self.view = memoryview(plaintext)
+        self.offset = 0
+
+    def unpack(self, struct_format: str):
+        values = struct.unpack_from(struct_format, self.view, self.offset)
+        self.offset += struct.calcsize(struct_format)
+        return values
+
+    def read_raw(self, size: int) -> memoryview:
+        data = self.view[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def read_bytes(self) -> memoryview:
+        size, = self.unpack(COUNT_FORMAT)
+        return self.read_raw(size)
+
+    def read_blocks(self):
+        count, = self.unpack(COUNT_FORMAT)
+        blocks = []
+        for _ in range(count):
+            data_id, leaf_index, data_length = self.unpack(BLOCK_FORMAT)
+            blocks.append((data_id, leaf_index, bytes(self.read_raw(data_length))))
+        return blocks
+
+    def read_pairs(self):
+        count, = self.unpack(COUNT_FORMAT)
+        return [self.unpack(PAIR_FORMAT) for _ in range(count)]
+
+
+def write_position_map(writer: StateWriter, position_map):
+    if isinstance(position_map, DictPositionMap):
+        writer.pack('>B', DICT_POSITION_MAP)
+        writer.write_pairs(position_map.items())
+    elif isinstance(position_map, ArrayPositionMap):
+        writer.pack('>B', ARRAY_POSITION_MAP)
+        leaves = array(position_map.leaves.typecode, position_map.leaves)
+        if sys.byteorder == 'little':  # the snapshot is big endian
+            leaves.byteswap()
+        writer.write_bytes(leaves.tobytes())
+        writer.pack(COUNT_FORMAT, position_map.num_of_entries)
+        writer.write_pairs(position_map.sparse_leaves.items())
+    else:  # the levels of a recursive map live on their own servers
+        raise ValueError(f'{type(position_map).__name__} can not be saved in a client snapshot')
+
+
+def read_position_map(reader: StateReader):
+    kind, = reader.unpack('>B')
+    if kind == DICT_POSITION_MAP:
+        return DictPositionMap(reader.read_pairs())
+    position_map = ArrayPositionMap(0)
+    position_map.leaves.frombytes(reader.read_bytes())
+    if sys.byteorder == 'little':
+        position_map.leaves.byteswap()
+    position_map.num_of_entries, = reader.unpack(COUNT_FORMAT)
+    position_map.sparse_leaves.update(reader.read_pairs())
+    return position_map
+
+
+def encode_client_state(client: Client) -> bytearray:
+    """
+    return the plaintext snapshot of the client state - geometry, keys, nonce counter, position map, stash,
+    initialized buckets bitmap, treetop buckets and leaves of lazily deleted blocks
+    """
+    writer = StateWriter()
+    writer.pack(GEOMETRY_FORMAT, client.num_of_files, client.bucket_size, client.data_size, client.treetop_levels,
+                client.nonce_counter, client.max_stash_size)
+    writer.buffer += client.secret_key
+    writer.write_bytes(client.initialized_buckets)
+    write_position_map(writer, client.position_map)
+    writer.write_blocks([(data_id, leaf_index, data) for data_id, (leaf_index, data) in client.stash.items()])
+    for blocks in client.treetop_buckets:
+        writer.write_blocks(blocks)
+    writer.write_pairs(client.deleted_leaves.items())
+    return writer.buffer
+
+
+def decode_client_state(plaintext: bytearray, server, crypto_pool=None, metrics=DISABLED_METRICS) -> Client:
+    """
+    return a client with the state of the given plaintext snapshot, attached to the given server.
+    the tree on the server is not touched
+    """
+    reader = StateReader(plaintext)
+    N, bucket_size, data_size, treetop_levels, nonce_counter, max_stash_size = reader.unpack(GEOMETRY_FORMAT)
+    secret_key = bytes(reader.read_raw(KEY_SIZE))
+    initialized_buckets = bytearray(reader.read_bytes())
+    position_map = read_position_map(reader)
+
+    client = Client(N, server, bucket_size, data_size, position_map, lazy_init=True, treetop_levels=treetop_levels,
+                    crypto_pool=crypto_pool, metrics=metrics)
+    if len(initialized_buckets) != len(client.initialized_buckets):
+        raise ValueError('snapshot does not match the tree geometry')
+    client.secret_key = secret_key
+    # a fresh nonce prefix - nonces used after the snapshot was taken are never repeated
+    client.nonce_prefix = get_random_bytes(NONCE_PREFIX_SIZE)
+    client.nonce_counter = nonce_counter
+    client.max_stash_size = max_stash_size
+    client.initialized_buckets = initialized_buckets
+    client.stash = {data_id: (leaf_index, data) for data_id, leaf_index, data in reader.read_blocks()}
+    client.treetop_buckets = [reader.read_blocks() for _ in range(client.treetop_size)]
+    client.deleted_leaves = dict(reader.read_pairs())
+    return client
+
+
+def save_client_state(client: Client, file_path: str, user_key: Union[str, bytes]):
+    """
+    write a versioned snapshot of the client state to the given file, encrypted with AES-GCM under a key
+    derived from user_key. the file is replaced atomically. save after the last access (and after flushing
+    the server), since a client restored from an older snapshot does not match the tree.
+    raise ValueError if the client can not be saved (a RingClient, a recursive position map or buckets of a failed
+    write which were not written again)
+    """
+    if isinstance(client, RingClient):  # the snapshot does not hold the ring state (e.g. the bucket metadata)
+        raise ValueError(f'{type(client).__name__} can not be saved in a client snapshot')
+    if client.unwritten_buckets:  # the tree on the server is behind the stash until they are written again
+        raise ValueError('buckets of a failed write were not written yet - the client can not be saved')
+    salt = get_random_bytes(SALT_SIZE)
+    nonce = get_random_bytes(NONCE_SIZE)
+    header = struct.pack(STATE_HEADER_FORMAT, STATE_MAGIC, STATE_VERSION, salt, nonce)
+    cipher = AES.new(derive_state_key(user_key, salt), AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    ciphertext, tag = cipher.encrypt_and_digest(encode_client_state(client))
+
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'wb') as state_file:
+        state_file.write(header)
+        state_file.write(ciphertext)
+        state_file.write(tag)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(temporary_path, file_path)
+
+
+def load_client_state(file_path: str, user_key: Union[str, bytes], server, crypto_pool=None,
+                      metrics=DISABLED_METRICS) -> Client:
+    """
+    return a client restored from a snapshot written by save_client_state, attached to the given server
+    (typically a Server over the MmapStorage file of the same tree). takes time proportional to the size of
+    the state - the tree is not re-encrypted.
+    raise ValueError if the file is not a snapshot, has an unsupported version or the key is wrong
+    """
+    with open(file_path, 'rb') as state_file:
+        content = state_file.read()
+    if len(content) < STATE_HEADER_SIZE + TAG_SIZE:
+        raise ValueError(f'{file_path} is not a client snapshot')
+    magic, version, salt, nonce = struct.unpack_from(STATE_HEADER_FORMAT, content)
+    if magic != STATE_MAGIC:
+        raise ValueError(f'{file_path} is not a client snapshot')
+    if version != STATE_VERSION:
+        raise ValueError(f'unsupported client snapshot version {version}')
+
+    cipher = AES.new(derive_state_key(user_key, salt), AES.MODE_GCM, nonce=nonce)
+    cipher.update(content[:STATE_HEADER_SIZE])
+    try:
+        plaintext = bytearray(cipher.decrypt_and_verify(content[STATE_HEADER_SIZE:-TAG_SIZE], content[-TAG_SIZE:]))
+    except ValueError:
+        raise ValueError('wrong key or corrupted client snapshot')
+    return decode_client_state(plaintext, server, crypto_pool, metrics)
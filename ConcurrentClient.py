@@ -0,0 +1,185 @@
+# Jonathan Birnbaum
+
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, List, Union
+from Client import Client
+
+DEFAULT_PATHS_PER_ROUND = 8
+DEFAULT_BATCH_WAIT = 0.001  # seconds to wait for more requests before starting a round
+
+
+class Request:
+    """
+    a single request waiting to be served by ConcurrentClient
+    """
+
+    def __init__(self, operation: str, data_id: int, new_data: Union[bytes, Callable, None]):
+        self.operation = operation
+        self.data_id = data_id
+        self.new_data = new_data
+        self.future = Future()
+
+
+class ConcurrentClient:
+    """
+    concurrent front end of a Client - accepts requests from many threads or asyncio tasks at once and serves
+    them in rounds (in the style of TaoStore / ObliviStore). every round reads exactly paths_per_round paths
+    (paths of the requested data ids, padded with random dummy paths) in one server call, answers all the
+    requests of the round from the stash - several requests of the same data id cost a single path - and
+    writes all the paths back in one server call.
+    the wrapped client must not be used directly while the front end is running
+    """
+
+    def __init__(self, client: Client, server, paths_per_round: int = DEFAULT_PATHS_PER_ROUND,
+                 batch_wait: float = DEFAULT_BATCH_WAIT):
+        """
+        :param client: the client which holds the stash, position map and keys
+        :param server: server object (Server or RemoteServer)
+        :param paths_per_round: number of paths read and written in every round
+        :param batch_wait: seconds to wait for more requests once a round has a first request
+        """
+        self.client = client
+        self.server = server
+        self.paths_per_round = paths_per_round
+        self.batch_wait = batch_wait
+        self.incoming_requests = queue.Queue()
+        self.pending_requests = deque()  # requests which were received and not served yet, in order
+        self.num_of_rounds = 0
+        self.is_running = True
+        self.worker = threading.Thread(target=self.serve_rounds, daemon=True)
+        self.worker.start()
+
+    # __________________ API methods __________________
+
+    def submit(self, operation: str, data_id: int, new_data: Union[bytes, Callable] = None) -> Future:
+        """
+        queue a request. return a future of the data stored with the given id before the operation
+        (None if there was no such data)
+        :param operation: one of Operations
+        :param data_id: int of data id
+        :param new_data: data to write for Operations.WRITE, or a function from the current data to the new data
+         for Operations.UPDATE
+        """
+        if not self.is_running:
+            raise RuntimeError('concurrent client is closed')
+        request = Request(operation, data_id, new_data)
+        self.incoming_requests.put(request)
+        return request.future
+
+    def access(self, operation: str, data_id: int, new_data: Union[bytes, Callable] = None) -> Union[bytes, None]:
+        """
+        blocking request - wait for the round that serves it
+        """
+        return self.submit(operation, data_id, new_data).result()
+
+    async def access_async(self, operation: str, data_id: int,
+                           new_data: Union[bytes, Callable] = None) -> Union[bytes, None]:
+        """
+        request for asyncio tasks - await the round that serves it
+        """
+        return await asyncio.wrap_future(self.submit(operation, data_id, new_data))
+
+    def close(self):
+        """
+        serve all the queued requests and stop the worker thread
+        """
+        self.is_running = False
+        self.incoming_requests.put(None)
+        self.worker.join()
+
+    # __________________ Rounds __________________
+
+    def receive_requests(self, block: bool) -> bool:
+        """
+        move incoming requests to the pending requests. return False once the front end was closed
+        """
+        try:
+            request = self.incoming_requests.get(block=block)
+            while True:
+                if request is None:
+                    return False
+                self.pending_requests.append(request)
+                request = self.incoming_requests.get_nowait()
+        except queue.Empty:
+            return True
+
+    def take_round_requests(self) -> List[Request]:
+        """
+        take the pending requests of the next round in order - requests of up to paths_per_round different
+        data ids. requests of other data ids stay pending (so requests of one data id are served in order)
+        """
+        round_requests = []
+        round_data_ids = set()
+        remaining_requests = deque()
+        for request in self.pending_requests:
+            if request.data_id in round_data_ids or len(round_data_ids) < self.paths_per_round:
+                round_data_ids.add(request.data_id)
+                round_requests.append(request)
+            else:
+                remaining_requests.append(request)
+        self.pending_requests = remaining_requests
+        return round_requests
+
+    def serve_rounds(self):
+        is_open = True
+        while is_open or self.pending_requests:
+            if is_open:
+                is_open = self.receive_requests(block=not self.pending_requests)
+                if is_open and self.batch_wait and len(self.pending_requests) < self.paths_per_round:
+                    time.sleep(self.batch_wait)
+                    is_open = self.receive_requests(block=False)
+            round_requests = self.take_round_requests()
+            if not round_requests:
+                continue
+            try:
+                results = self.serve_round(round_requests)
+            except Exception as e:  # fail the requests of the round, keep serving the next rounds
+                for request in round_requests:
+                    request.future.set_exception(e)
+            else:
+                for request, result in zip(round_requests, results):
+                    if isinstance(result, Exception):
+                        request.future.set_exception(result)
+                    else:
+                        request.future.set_result(result)
+
+    def serve_round(self, round_requests: List[Request]) -> List[Union[bytes, None, Exception]]:
+        """
+        read the paths of the data ids of the round (padded to paths_per_round paths), perform the requests on
+        the stash in order, remap every block to a new random leaf and write all the paths back.
+        a request which raises (an UPDATE function) does not change its block and does not stop the round
+        :return: result of every request - the error of a request which raised
+        """
+        client = self.client
+        data_ids = list(dict.fromkeys(request.data_id for request in round_requests))
+        leaf_indices = []
+        for data_id in data_ids:
+            leaf_index = client.position_map.get(data_id)
+            leaf_indices.append(leaf_index if leaf_index is not None else client.get_leaf_of_unmapped(data_id))
+        while len(leaf_indices) < self.paths_per_round:  # dummy paths
+            leaf_indices.append(client.generate_new_leaf_index())
+
+        bucket_indices = client.read_paths_to_stash(leaf_indices, self.server)
+
+        new_leaf_indices = {data_id: client.generate_new_leaf_index() for data_id in data_ids}
+        results = []
+        for request in round_requests:
+            try:
+                results.append(client.apply_operation(request.operation, request.data_id, request.new_data,
+                                                      new_leaf_indices[request.data_id]))
+            except Exception as e:
+                results.append(e)
+        for data_id in data_ids:
+            if data_id in client.stash:
+                client.position_map[data_id] = new_leaf_indices[data_id]
+            else:
+                client.position_map.pop(data_id, None)
+
+        client.write_paths_from_stash(bucket_indices, self.server)
+        self.num_of_rounds += 1
+        return results
@@ -0,0 +1,202 @@
+# Jonathan Birnbaum
+
+import math
+import threading
+from contextlib import nullcontext
+from timeit import default_timer as timer
+from typing import Callable, Dict
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+ERROR = 'error'
+
+
+class Histogram:
+    """
+    summary of observed values - count, sum, min, max and counts per power-of-two bucket, so the memory
+    used does not grow with the number of observations
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.bucket_counts = dict()  # exponent e -> number of values in [2**(e-1), 2**e)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        exponent = math.frexp(value)[1] if value > 0 else None
+        self.bucket_counts[exponent] = self.bucket_counts.get(exponent, 0) + 1
+
+    def merge(self, other):
+        """
+        add the values observed by another histogram
+        """
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for exponent, count in other.bucket_counts.items():
+            self.bucket_counts[exponent] = self.bucket_counts.get(exponent, 0) + count
+
+    def get_percentile(self, percent: float) -> float:
+        """
+        return an upper bound of the given percentile (accurate to a factor of 2, and never above max)
+        """
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(percent / 100 * self.count)
+        seen = self.bucket_counts.get(None, 0)
+        if seen >= rank:
+            return 0.0
+        for exponent in sorted(exponent for exponent in self.bucket_counts if exponent is not None):
+            seen += self.bucket_counts[exponent]
+            if seen >= rank:
+                return min(2.0 ** exponent, self.max)
+        return self.max
+
+    def snapshot(self) -> Dict:
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count,
+                'sum': self.total,
+                'mean': self.total / self.count,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.get_percentile(50),
+                'p95': self.get_percentile(95),
+                'p99': self.get_percentile(99)}
+
+
+class PhaseTimer:
+    """
+    context manager which observes the seconds spent in a phase in the histogram <phase>_seconds
+    """
+
+    def __init__(self, metrics, phase: str):
+        self.metrics = metrics
+        self.histogram_name = f'{phase}_seconds'
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.histogram_name, timer() - self.start)
+
+
+class Metrics:
+    """
+    counters, histograms and phase timers of a Client or a Server. read them with snapshot(), or register
+    a listener which is called with (kind, name, value) for every counter increment, observed value and error.
+    the counters and histograms may be updated by several threads
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        for listener in self.listeners:
+            listener(COUNTER, name, amount)
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+        for listener in self.listeners:
+            listener(HISTOGRAM, name, value)
+
+    def phase(self, name: str) -> PhaseTimer:
+        """
+        return a context manager which times the phase of the given name
+        """
+        return PhaseTimer(self, name)
+
+    def record_error(self, name: str, error: Exception):
+        """
+        count an error (counter <name>_errors) and pass it to the listeners
+        """
+        self.increment(f'{name}_errors')
+        for listener in self.listeners:
+            listener(ERROR, name, error)
+
+    def add_listener(self, listener: Callable):
+        self.listeners.append(listener)
+
+    def get_counter(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    def merge(self, counters: Dict[str, int], histograms: Dict[str, Histogram]):
+        """
+        add counters and histograms recorded elsewhere (e.g. by the Metrics of another process)
+        """
+        with self.lock:
+            for name, amount in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for name, other in histograms.items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.merge(other)
+
+    def snapshot(self) -> Dict:
+        """
+        return the current counters and histogram summaries
+        """
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+class DisabledMetrics:
+    """
+    metrics which record nothing - the default of Client and Server, so instrumentation costs a method call
+    """
+
+    enabled = False
+
+    def increment(self, name: str, amount: int = 1):
+        pass
+
+    def observe(self, name: str, value: float):
+        pass
+
+    def phase(self, name: str):
+        return NO_PHASE
+
+    def record_error(self, name: str, error: Exception):
+        pass
+
+    def get_counter(self, name: str) -> int:
+        return 0
+
+    def merge(self, counters: Dict[str, int], histograms: Dict[str, Histogram]):
+        pass
+
+    def snapshot(self) -> Dict:
+        return {'counters': {}, 'histograms': {}}
+
+    def reset(self):
+        pass
+
+
+NO_PHASE = nullcontext()
+DISABLED_METRICS = DisabledMetrics()
@@ -0,0 +1,405 @@
+# Jonathan Birnbaum
+
+import argparse
+import asyncio
+import itertools
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+from typing import List, Tuple, Union
+from Server import Server
+
+FRAME_HEADER_FORMAT = '>IIB'  # payload length, request id, opcode (request) or status (response)
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+COUNT_FORMAT = '>I'
+COUNT_SIZE = struct.calcsize(COUNT_FORMAT)
+INDEX_FORMAT = 'q'
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+PATH_FORMAT = '>qI'  # leaf index, first level of the path
+PATH_SIZE = struct.calcsize(PATH_FORMAT)
+MISSING_BUCKET_LENGTH = 0xFFFFFFFF  # length sent for a bucket that was never written
+STATUS_OK = 0
+STATUS_ERROR = 1
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_POOL_SIZE = 4
+
+
+class Opcodes:
+    GET_BUCKETS = 1
+    WRITE_BUCKETS = 2
+    READ_PATH = 3
+    WRITE_PATH = 4
+    FLUSH = 5
+
+
+# __________________ Framing __________________
+
+def encode_frame(request_id: int, code: int, payload_parts: List) -> List:
+    """
+    return the parts of a frame (header + payload) of the given request id and opcode / status
+    """
+    payload_length = sum(len(part) for part in payload_parts)
+    return [struct.pack(FRAME_HEADER_FORMAT, payload_length, request_id, code)] + payload_parts
+
+
+def encode_indices(indices: List[int]) -> bytes:
+    """
+    return the binary form of a list of indices (count + indices)
+    """
+    return struct.pack(f'>I{len(indices)}{INDEX_FORMAT}', len(indices), *indices)
+
+
+def decode_indices(payload, offset: int = 0) -> Tuple[List[int], int]:
+    """
+    return the list of indices encoded in the payload at the given offset, and the offset after it
+    """
+    count, = struct.unpack_from(COUNT_FORMAT, payload, offset)
+    offset += COUNT_SIZE
+    indices = list(struct.unpack_from(f'>{count}{INDEX_FORMAT}', payload, offset))
+    return indices, offset + (count * INDEX_SIZE)
+
+
+def encode_buckets(buckets: List) -> List:
+    """
+    return the parts of the binary form of a batch of buckets (count + length and bytes of every bucket).
+    the buckets themselves are not copied
+    """
+    parts = [struct.pack(COUNT_FORMAT, len(buckets))]
+    for bucket in buckets:
+        if bucket is None:
+            parts.append(struct.pack(COUNT_FORMAT, MISSING_BUCKET_LENGTH))
+        else:
+            parts.append(struct.pack(COUNT_FORMAT, len(bucket)))
+            parts.append(bucket)
+    return parts
+
+
+def decode_buckets(payload, offset: int = 0) -> Tuple[List[Union[memoryview, None]], int]:
+    """
+    return the batch of buckets encoded in the payload at the given offset (zero-copy memoryview slices of the
+    payload), and the offset after it
+    """
+    payload_view = memoryview(payload)
+    count, = struct.unpack_from(COUNT_FORMAT, payload, offset)
+    offset += COUNT_SIZE
+    buckets = []
+    for _ in range(count):
+        bucket_length, = struct.unpack_from(COUNT_FORMAT, payload, offset)
+        offset += COUNT_SIZE
+        if bucket_length == MISSING_BUCKET_LENGTH:
+            buckets.append(None)
+        else:
+            buckets.append(payload_view[offset:offset + bucket_length])
+            offset += bucket_length
+    return buckets, offset
+
+
+# __________________ Server side __________________
+
+class NetworkServer:
+    """
+    asyncio TCP (or unix socket) server which exposes a Server to RemoteServer clients.
+    requests of a connection are handled in order while their responses are pipelined.
+    latency (in seconds) is added to every response to simulate a remote deployment on localhost
+    """
+
+    def __init__(self, server: Server, host: str = DEFAULT_HOST, port: int = 0, unix_path: str = None,
+                 latency: float = 0.0):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.latency = latency
+        self.address = None  # (host, port) or unix socket path, known after start()
+        self.asyncio_server = None
+        self.loop = None
+        self.thread = None
+
+    async def start(self):
+        """
+        start listening. the address to connect to is saved in self.address
+        """
+        if self.unix_path is not None:
+            self.asyncio_server = await asyncio.start_unix_server(self.handle_connection, self.unix_path)
+            self.address = self.unix_path
+        else:
+            self.asyncio_server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+            self.address = self.asyncio_server.sockets[0].getsockname()[:2]
+
+    def start_in_thread(self):
+        """
+        run the server in an event loop of a background thread. return the address to connect to
+        """
+        started = threading.Event()
+
+        def run_loop():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.start())
+            started.set()
+            self.loop.run_forever()
+            connection_tasks = asyncio.all_tasks(self.loop)
+            for task in connection_tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*connection_tasks, return_exceptions=True))
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run_loop, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.address
+
+    def stop(self):
+        """
+        stop a server that was started with start_in_thread()
+        """
+        def close_server():
+            self.asyncio_server.close()
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(close_server)
+        self.thread.join()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                header = await reader.readexactly(FRAME_HEADER_SIZE)
+                payload_length, request_id, opcode = struct.unpack(FRAME_HEADER_FORMAT, header)
+                payload = await reader.readexactly(payload_length)
+                try:
+                    status, response_parts = STATUS_OK, self.handle_request(opcode, payload)
+                except Exception as e:  # report the error to the client instead of dropping the connection
+                    status, response_parts = STATUS_ERROR, [str.encode(f'{type(e).__name__}: {e}')]
+
+                frame = b''.join(encode_frame(request_id, status, response_parts))
+                if self.latency:
+                    loop.call_later(self.latency, writer.write, frame)
+                else:
+                    writer.write(frame)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):  # closed or server stopped
+            pass
+        finally:
+            writer.close()
+
+    def handle_request(self, opcode: int, payload: bytes) -> List:
+        """
+        perform the request on the server and return the parts of the response payload
+        """
+        if opcode == Opcodes.GET_BUCKETS:
+            indices, _ = decode_indices(payload)
+            return encode_buckets(self.server.get_buckets_by_indices(indices))
+        if opcode == Opcodes.WRITE_BUCKETS:
+            indices, offset = decode_indices(payload)
+            buckets, _ = decode_buckets(payload, offset)
+            self.server.write_buckets_by_indices(indices, buckets)
+            return []
+        if opcode == Opcodes.READ_PATH:
+            leaf_index, from_level = struct.unpack(PATH_FORMAT, payload)
+            return encode_buckets(self.server.read_path(leaf_index, from_level))
+        if opcode == Opcodes.WRITE_PATH:
+            leaf_index, from_level = struct.unpack_from(PATH_FORMAT, payload)
+            buckets, _ = decode_buckets(payload, PATH_SIZE)
+            self.server.write_path(leaf_index, buckets, from_level)
+            return []
+        if opcode == Opcodes.FLUSH:
+            self.server.flush()
+            return []
+        raise ValueError(f'unknown opcode {opcode}')
+
+
+# __________________ Client side __________________
+
+class Connection:
+    """
+    a single pipelined connection to a NetworkServer - requests are sent without waiting for previous
+    responses, and a reader thread resolves the future of every response by its request id.
+    once the connection is lost, the pending requests and every later request fail with a ConnectionError
+    """
+
+    def __init__(self, address):
+        if isinstance(address, str):  # unix socket path
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        else:
+            self.socket = socket.create_connection(tuple(address))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending_requests = dict()  # request id -> Future
+        self.error = None  # the error which ended the connection
+        self.reader_thread = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader_thread.start()
+
+    def submit(self, request_id: int, opcode: int, payload_parts: List) -> Future:
+        future = Future()
+        with self.pending_lock:
+            if self.error is not None:
+                future.set_exception(ConnectionError(self.error))
+                return future
+            self.pending_requests[request_id] = future
+        frame_parts = encode_frame(request_id, opcode, payload_parts)
+        try:
+            with self.send_lock:
+                self.socket.sendall(b''.join(frame_parts))
+        except OSError as e:
+            self.fail_pending_requests(e)
+        return future
+
+    def fail_pending_requests(self, error: Exception):
+        """
+        mark the connection as dead and fail all the requests which wait for a response
+        """
+        with self.pending_lock:
+            if self.error is None:
+                self.error = error
+            pending_futures = list(self.pending_requests.values())
+            self.pending_requests.clear()
+        for future in pending_futures:
+            future.set_exception(ConnectionError(self.error))
+
+    def receive_exactly(self, size: int) -> bytearray:
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            chunk_size = self.socket.recv_into(view[received:])
+            if chunk_size == 0:
+                raise ConnectionError('connection closed by the server')
+            received += chunk_size
+        return buffer
+
+    def read_responses(self):
+        try:
+            while True:
+                header = self.receive_exactly(FRAME_HEADER_SIZE)
+                payload_length, request_id, status = struct.unpack(FRAME_HEADER_FORMAT, header)
+                payload = self.receive_exactly(payload_length)
+                with self.pending_lock:
+                    future = self.pending_requests.pop(request_id)
+                if status == STATUS_OK:
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RuntimeError(bytes.decode(bytes(payload))))
+        except (ConnectionError, OSError) as e:
+            self.fail_pending_requests(e)
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class RemoteServer:
+    """
+    proxy for a Server which is served by a NetworkServer - has the same interface as Server, so a Client
+    can use it without changes. requests are spread over a pool of pipelined connections
+    """
+
+    def __init__(self, address, pool_size: int = DEFAULT_POOL_SIZE, timeout: float = None):
+        """
+        :param address: (host, port) of a TCP NetworkServer or the path of a unix socket one
+        :param pool_size: number of connections to open
+        :param timeout: seconds to wait for the response of a call (None - no limit). a call which times out
+         raises concurrent.futures.TimeoutError, but it may still be performed by the server later
+        """
+        self.timeout = timeout
+        self.connections = [Connection(address) for _ in range(pool_size)]
+        self.request_ids = itertools.count()
+        self.next_connection = itertools.cycle(self.connections)
+        self.pool_lock = threading.Lock()
+
+    def submit(self, opcode: int, payload_parts: List) -> Future:
+        """
+        send a request without waiting for its response. return a future of the response payload.
+        requests submitted on different connections may be handled in any order
+        """
+        with self.pool_lock:
+            request_id = next(self.request_ids) & 0xFFFFFFFF
+            connection = next(self.next_connection)
+        return connection.submit(request_id, opcode, payload_parts)
+
+    def call(self, opcode: int, payload_parts: List):
+        """
+        send a request and wait for its response payload
+        """
+        return self.submit(opcode, payload_parts).result(self.timeout)
+
+    def get_bucket_by_index(self, index: int):
+        return self.get_buckets_by_indices([index])[0]
+
+    def get_buckets_by_indices(self, indices_list: List[int]):
+        buckets, _ = decode_buckets(self.call(Opcodes.GET_BUCKETS, [encode_indices(indices_list)]))
+        return buckets
+
+    def write_bucket_by_index(self, index: int, bucket: bytes):
+        self.write_buckets_by_indices([index], [bucket])
+
+    def write_buckets_by_indices(self, indices_list: List[int], buckets: List[bytes]):
+        self.call(Opcodes.WRITE_BUCKETS, [encode_indices(indices_list)] + encode_buckets(buckets))
+
+    def submit_read_path(self, leaf_index: int, from_level: int = 0) -> Future:
+        """
+        pipelined read_path - return a future of the response payload (decode it with decode_buckets)
+        """
+        return self.submit(Opcodes.READ_PATH, [struct.pack(PATH_FORMAT, leaf_index, from_level)])
+
+    def read_path(self, leaf_index: int, from_level: int = 0) -> List:
+        buckets, _ = decode_buckets(self.submit_read_path(leaf_index, from_level).result(self.timeout))
+        return buckets
+
+    def write_path(self, leaf_index: int, buckets: List[bytes], from_level: int = 0):
+        self.call(Opcodes.WRITE_PATH, [struct.pack(PATH_FORMAT, leaf_index, from_level)] + encode_buckets(buckets))
+
+    def flush(self):
+        self.call(Opcodes.FLUSH, [])
+
+    def close(self):
+        """
+        close the connections of the pool (the remote storage stays open)
+        """
+        for connection in self.connections:
+            connection.close()
+
+
+def main():
+    from Client import DATA_SIZE, DEFAULT_BUCKET_SIZE, get_encrypted_bucket_size
+    from Storage import MmapStorage
+    from Utils import get_tree_height, get_tree_size
+
+    parser = argparse.ArgumentParser(description='serve a Path ORAM server storage over the network')
+    parser.add_argument('-N', type=int, required=True, help='number of data blocks supported')
+    parser.add_argument('--bucket-size', type=int, default=DEFAULT_BUCKET_SIZE)
+    parser.add_argument('--data-size', type=int, default=DATA_SIZE)
+    parser.add_argument('--storage-file', help='keep the tree in this memory-mapped file (default: in memory)')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--unix-path', help='listen on this unix socket instead of TCP')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    args = parser.parse_args()
+
+    tree_size = get_tree_size(get_tree_height(args.N))
+    storage = None
+    if args.storage_file:
+        storage = MmapStorage(args.storage_file, tree_size, get_encrypted_bucket_size(args.bucket_size,
+                                                                                      args.data_size))
+    network_server = NetworkServer(Server(tree_size, storage), args.host, args.port, args.unix_path, args.latency)
+
+    async def serve():
+        await network_server.start()
+        print('Listening on', network_server.address, flush=True)
+        async with network_server.asyncio_server:
+            await network_server.asyncio_server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        network_server.server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Jonathan Birnbaum
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List
+
+
+class ParallelCrypto:
+    """
+    worker pool which decrypts / encrypts the buckets of a path (or of a batch of paths) in parallel.
+    pycryptodome releases the GIL inside its C code, so threads are used by default. processes avoid the GIL
+    altogether at the cost of copying every bucket to the worker and back.
+    with a single worker (or a single core) the work is done serially in the calling thread
+    """
+
+    def __init__(self, num_of_workers: int = None, use_processes: bool = False):
+        """
+        :param num_of_workers: size of the pool (default and maximum - number of cores)
+        :param use_processes: use a pool of processes instead of threads
+        """
+        num_of_cores = os.cpu_count() or 1
+        # more workers than cores only add scheduling and copying to the serial work
+        self.num_of_workers = min(num_of_workers or num_of_cores, num_of_cores)
+        self.use_processes = use_processes
+        self.executor = None
+        if self.num_of_workers > 1:
+            executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            self.executor = executor_class(self.num_of_workers)
+
+    def map(self, function: Callable, *iterables) -> List:
+        """
+        return the list of results of the function on every item of the iterables, computed by the pool
+        """
+        if self.executor is None:
+            return list(map(function, *iterables))
+        if self.use_processes:  # memoryviews can not be sent to another process
+            iterables = [[bytes(item) if isinstance(item, memoryview) else item for item in iterable]
+                         for iterable in iterables]
+            chunk_size = max(1, len(iterables[0]) // self.num_of_workers)
+            return list(self.executor.map(function, *iterables, chunksize=chunk_size))
+        return list(self.executor.map(function, *iterables))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
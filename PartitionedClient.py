@@ -0,0 +1,403 @@
+# Jonathan Birnbaum
+
+import math
+import multiprocessing
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple, Union
+from Client import Client, Operations, DATA_SIZE, DEFAULT_BUCKET_SIZE
+from Metrics import DISABLED_METRICS, Metrics
+from Server import Server
+from Utils import get_tree_height, get_tree_size
+
+DUMMY_DATA_ID = -1  # never stored - an access to it reads and writes a random path of a partition
+DEFAULT_EVICTIONS_PER_ACCESS = 2  # must be above 1 so the eviction cache does not grow
+PARTITION_CAPACITY_FACTOR = 2  # blocks supported by every partition, relative to N / num_of_partitions
+# requests of the front end to a partition worker process
+RUN = 'run'
+COLLECT_METRICS = 'collect_metrics'
+GET_MAX_STASH_SIZE = 'get_max_stash_size'
+
+
+# __________________ Partition Workers __________________
+
+def create_partition_clients(partitions: List[int], partition_capacity: int, tree_size: int, server_factory: Callable,
+                             bucket_size: int, data_size: int, metrics) -> Tuple[Dict, Dict]:
+    """
+    return the servers and the sub-clients of the given partitions (partition -> Server, partition -> Client)
+    """
+    servers = {partition: server_factory(tree_size, metrics=metrics) for partition in partitions}
+    clients = {partition: Client(partition_capacity, servers[partition], bucket_size, data_size, lazy_init=True,
+                                 metrics=metrics)
+               for partition in partitions}
+    return servers, clients
+
+
+def run_partition(client: Client, server, operations: List[Tuple[str, int, Union[bytes, None]]]) \
+        -> Tuple[List, Union[Exception, None]]:
+    """
+    perform sub-tree accesses (operation, data_id, new_data) of one partition in order, until one fails. return
+    the results of the performed accesses and the error (None if all of them succeeded). an access whose write
+    back failed counts as performed - the sub-client keeps its blocks (see Client.access)
+    """
+    results = []
+    for operation, data_id, new_data in operations:
+        removed_data = []
+
+        def remove_block(data):  # a DELETE which keeps the data even if the write back fails
+            removed_data.append(None if data is None else bytes(data))
+
+        try:
+            if operation == Operations.DELETE:
+                client.access(server, Operations.UPDATE, data_id, remove_block)
+                results.append(removed_data[0])
+            else:
+                data = client.access(server, operation, data_id, new_data)
+                results.append(None if data is None else bytes(data))
+        except Exception as error:
+            if removed_data:
+                results.append(removed_data[0])
+            elif operation == Operations.WRITE and data_id in client.stash:
+                results.append(None)
+            return results, error
+    return results, None
+
+
+def serve_partitions(connection, partitions: List[int], partition_capacity: int, tree_size: int,
+                     server_factory: Callable, bucket_size: int, data_size: int, metrics_enabled: bool):
+    """
+    main function of a partition worker process - own the servers and sub-clients of the given partitions and
+    serve the requests (request, argument) of the front end until None is received. the reply to a request is
+    its result, or the exception it raised
+    """
+    metrics = Metrics() if metrics_enabled else DISABLED_METRICS
+    servers, clients = create_partition_clients(partitions, partition_capacity, tree_size, server_factory,
+                                                bucket_size, data_size, metrics)
+    try:
+        for request, argument in iter(connection.recv, None):
+            try:
+                if request == RUN:
+                    reply = {partition: run_partition(clients[partition], servers[partition], operations)
+                             for partition, operations in argument.items()}
+                elif request == COLLECT_METRICS:
+                    reply = (dict(metrics.counters), dict(metrics.histograms)) if metrics.enabled else ({}, {})
+                    metrics.reset()
+                else:  # GET_MAX_STASH_SIZE
+                    reply = max(client.max_stash_size for client in clients.values())
+            except Exception as error:
+                reply = error
+            connection.send(reply)
+    finally:
+        for server in servers.values():
+            server.close()
+        connection.close()
+
+
+class ProcessPartitions:
+    """
+    the partitions spread over worker processes (partition p is owned by worker p % num_of_workers), so the
+    sub-trees are accessed in parallel on several cores. only sub-tree accesses with bytes cross the pipes
+    """
+
+    def __init__(self, num_of_partitions: int, partition_capacity: int, tree_size: int, server_factory: Callable,
+                 bucket_size: int, data_size: int, num_of_workers: int, metrics):
+        self.num_of_workers = num_of_workers
+        self.metrics = metrics
+        self.connections = []
+        self.processes = []
+        for worker_number in range(num_of_workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=serve_partitions, daemon=True,
+                args=(worker_connection, list(range(worker_number, num_of_partitions, num_of_workers)),
+                      partition_capacity, tree_size, server_factory, bucket_size, data_size, metrics.enabled))
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def request_workers(self, request: str, arguments: Dict[int, object]) -> Dict[int, object]:
+        """
+        send a request to the given workers (worker -> argument) and return their replies once all are received.
+        the reply of a worker whose request failed is the exception it raised
+        """
+        for worker_number, argument in arguments.items():
+            self.connections[worker_number].send((request, argument))
+        return {worker_number: self.connections[worker_number].recv() for worker_number in arguments}
+
+    def request_all_workers(self, request: str) -> List:
+        """
+        send a request without an argument to every worker and return their replies. raise the first error
+        """
+        replies = list(self.request_workers(request, dict.fromkeys(range(self.num_of_workers))).values())
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def run(self, operations_by_partition: Dict[int, List]) -> Dict[int, Tuple[List, Union[Exception, None]]]:
+        operations_by_worker = dict()
+        for partition, operations in operations_by_partition.items():
+            operations_by_worker.setdefault(partition % self.num_of_workers, dict())[partition] = operations
+        results = dict()
+        for worker_number, reply in self.request_workers(RUN, operations_by_worker).items():
+            if isinstance(reply, Exception):  # the worker failed - so did every partition it was given
+                reply = dict.fromkeys(operations_by_worker[worker_number], ([], reply))
+            results.update(reply)
+        return results
+
+    def collect_metrics(self):
+        for counters, histograms in self.request_all_workers(COLLECT_METRICS):
+            self.metrics.merge(counters, histograms)
+
+    def get_max_stash_size(self) -> int:
+        return max(self.request_all_workers(GET_MAX_STASH_SIZE))
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+
+
+class ThreadPartitions:
+    """
+    the partitions in the process of the front end, accessed in parallel by a pool of threads. the sub-clients
+    share the Metrics of the front end
+    """
+
+    def __init__(self, num_of_partitions: int, partition_capacity: int, tree_size: int, server_factory: Callable,
+                 bucket_size: int, data_size: int, num_of_workers: int, metrics):
+        self.servers, self.clients = create_partition_clients(list(range(num_of_partitions)), partition_capacity,
+                                                              tree_size, server_factory, bucket_size, data_size,
+                                                              metrics)
+        self.executor = ThreadPoolExecutor(num_of_workers)
+
+    def run(self, operations_by_partition: Dict[int, List]) -> Dict[int, Tuple[List, Union[Exception, None]]]:
+        futures = {partition: self.executor.submit(run_partition, self.clients[partition], self.servers[partition],
+                                                   operations)
+                   for partition, operations in operations_by_partition.items()}
+        return {partition: future.result() for partition, future in futures.items()}
+
+    def collect_metrics(self):
+        pass
+
+    def get_max_stash_size(self) -> int:
+        return max(client.max_stash_size for client in self.clients.values())
+
+    def close(self):
+        self.executor.shutdown()
+        for server in self.servers.values():
+            server.close()
+
+
+# __________________ Partitioned Client __________________
+
+class PartitionedClient:
+    """
+    partitioned ORAM (Stefanov, Shi and Song) - the data ids are spread over num_of_partitions independent Path
+    ORAM sub-trees, each with its own Server (which may be a RemoteServer of another process). the client keeps
+    the partition of every data id and an eviction cache per partition.
+    an access reads the block from its partition (or a random partition if the block is cached or not stored)
+    and moves it to the cache of a new random partition. then evictions_per_access partitions, chosen at
+    random independently of the data, write one cached block each (or a dummy). so the server sees reads of
+    uniformly random partitions and writes to random partitions, whatever the access pattern.
+    the sub-trees of a batch of accesses are accessed in parallel - by worker processes which own the sub-clients
+    and their servers (so the encryption work scales with the cores), or by a pool of threads of this process
+    """
+
+    def __init__(self, N: int, num_of_partitions: int, server_factory: Callable = Server,
+                 bucket_size: int = DEFAULT_BUCKET_SIZE, data_size: int = DATA_SIZE,
+                 evictions_per_access: int = DEFAULT_EVICTIONS_PER_ACCESS, num_of_workers: int = None,
+                 use_processes: bool = True, metrics=DISABLED_METRICS):
+        """
+        :param N: number of data blocks supported
+        :param num_of_partitions: number of sub-trees (P)
+        :param server_factory: function from a tree size and a Metrics (keyword metrics) to the server which stores
+        a partition. with use_processes it is called in the worker processes, so it must be picklable (e.g. a
+        module-level function or class)
+        :param bucket_size: number of blocks in each bucket of the sub-trees (Z)
+        :param data_size: maximal size in bytes of the data of each block
+        :param evictions_per_access: number of partitions evicted to after every access
+        :param num_of_workers: number of processes or threads which access the partitions (default - one per
+        partition)
+        :param use_processes: whether the partitions are accessed by worker processes or by threads
+        :param metrics: Metrics of the sub-clients and servers (disabled by default). with use_processes the
+        workers record their own metrics, which are added to it by collect_metrics()
+        """
+        self.num_of_partitions = num_of_partitions
+        self.evictions_per_access = evictions_per_access
+        self.metrics = metrics
+        partition_capacity = max(1, math.ceil(N / num_of_partitions * PARTITION_CAPACITY_FACTOR))
+        tree_size = get_tree_size(get_tree_height(partition_capacity))
+        num_of_workers = min(num_of_workers or num_of_partitions, num_of_partitions)
+        partitions_class = ProcessPartitions if use_processes else ThreadPartitions
+        self.partitions = partitions_class(num_of_partitions, partition_capacity, tree_size, server_factory,
+                                           bucket_size, data_size, num_of_workers, metrics)
+        self.partition_map = dict()  # data id -> partition of the block (sub-tree or eviction cache)
+        # blocks waiting to be written to their partition - data id -> data, for every partition
+        self.eviction_caches = [dict() for _ in range(num_of_partitions)]
+        self.max_eviction_cache_size = 0
+
+    def generate_new_partition(self) -> int:
+        """
+        return a random partition
+        """
+        return secrets.randbelow(self.num_of_partitions)
+
+    def is_cached(self, data_id: int) -> bool:
+        partition = self.partition_map.get(data_id)
+        return partition is not None and data_id in self.eviction_caches[partition]
+
+    def run_on_partitions(self, operations_by_partition: Dict[int, List[Tuple[str, int, Union[bytes, None]]]]) \
+            -> Tuple[Dict[int, List], Union[Exception, None]]:
+        """
+        perform the given sub-tree accesses (operation, data_id, new_data) - partitions in parallel, the accesses
+        of one partition in order until one fails. return the results of the performed accesses of every
+        partition, and the first error (None if all of them succeeded)
+        """
+        results, error = dict(), None
+        for partition, (partition_results, partition_error) in self.partitions.run(operations_by_partition).items():
+            results[partition] = partition_results
+            error = error or partition_error
+        return results, error
+
+    def take_step(self, requests: List[Tuple[str, int, Union[bytes, Callable, None]]], first: int) -> Dict[int, Tuple]:
+        """
+        choose the read partition of the requests from index first on, as long as the partitions are distinct
+        (at least one request). return request index -> (read partition, data id to read)
+        """
+        step = dict()
+        step_data_ids = set()
+        for request_index in range(first, len(requests)):
+            data_id = requests[request_index][1]
+            if data_id in step_data_ids or data_id not in self.partition_map or self.is_cached(data_id):
+                # the block is not in a sub-tree (or is read earlier in this step) - read a random partition
+                read_partition, read_data_id = self.generate_new_partition(), DUMMY_DATA_ID
+            else:
+                read_partition, read_data_id = self.partition_map[data_id], data_id
+            if step and any(partition == read_partition for partition, _ in step.values()):
+                break
+            step[request_index] = (read_partition, read_data_id)
+            step_data_ids.add(data_id)
+        return step
+
+    def access_many(self, requests: List[Tuple[str, int, Union[bytes, Callable, None]]]) -> List[Union[bytes, None]]:
+        """
+        perform the requests (operation, data_id, new_data) in order and return the data stored with every data id
+        before its request (None if there was no such data). requests are served in steps of reads of distinct
+        partitions which run in parallel, each step followed by its evictions (also in parallel).
+        if a request fails (e.g. the function of an UPDATE raises) every block read by its step is kept, the step
+        and its evictions are finished and the error is raised. the requests of the step after the failed one
+        (all of them if a read failed) and the later requests are not performed
+        """
+        results = []
+        error = None
+        while len(results) < len(requests) and error is None:
+            step = self.take_step(requests, len(results))
+            # read phase - every real block is removed from its sub-tree (DELETE), others read a dummy path
+            read_results, error = self.run_on_partitions({partition: [(Operations.DELETE, read_data_id, None)]
+                                                          for partition, read_data_id in step.values()})
+            for request_index, (partition, read_data_id) in step.items():
+                operation, data_id, new_data = requests[request_index]
+                if read_data_id == DUMMY_DATA_ID:
+                    old_partition = self.partition_map.get(data_id)
+                    data = None if old_partition is None else self.eviction_caches[old_partition].pop(data_id, None)
+                elif read_results[partition]:
+                    data = read_results[partition][0]
+                else:  # the read was not performed - the block stays in its sub-tree
+                    continue
+                results.append(data)
+                try:
+                    # after a failure the blocks of the step are only kept
+                    self.apply_operation(operation if error is None else Operations.READ, data_id, data, new_data)
+                except Exception as e:
+                    error = e
+            try:
+                self.evict(self.evictions_per_access * len(step))
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def access(self, operation: str, data_id: int, new_data: Union[bytes, Callable] = None) -> Union[bytes, None]:
+        """
+        single access (see Client.access). return the data stored with the given id before the operation
+        """
+        return self.access_many([(operation, data_id, new_data)])[0]
+
+    def apply_operation(self, operation: str, data_id: int, data: Union[bytes, None],
+                        new_data: Union[bytes, Callable, None]):
+        """
+        perform the operation on the block read by the access and put the block that is kept in the eviction
+        cache of a new random partition. if the function of an UPDATE raises, the block is kept unchanged and the
+        error is raised
+        """
+        if operation == Operations.READ:
+            updated_data = data
+        elif operation == Operations.WRITE:
+            updated_data = new_data
+        elif operation == Operations.UPDATE:
+            try:
+                updated_data = new_data(data)
+            except Exception:
+                self.apply_operation(Operations.READ, data_id, data, None)
+                raise
+        else:  # Operations.DELETE
+            updated_data = None
+
+        if updated_data is None:
+            self.partition_map.pop(data_id, None)
+            return
+        new_partition = self.generate_new_partition()
+        self.partition_map[data_id] = new_partition
+        self.eviction_caches[new_partition][data_id] = updated_data
+
+    def evict(self, num_of_evictions: int):
+        """
+        write one cached block (or a dummy) to each of num_of_evictions random partitions. the blocks whose writes
+        were not performed are put back in their eviction caches, and the first error is raised
+        """
+        operations_by_partition = dict()
+        for _ in range(num_of_evictions):
+            partition = self.generate_new_partition()
+            eviction_cache = self.eviction_caches[partition]
+            if eviction_cache:
+                data_id = next(iter(eviction_cache))
+                operation = (Operations.WRITE, data_id, eviction_cache.pop(data_id))
+            else:
+                operation = (Operations.DELETE, DUMMY_DATA_ID, None)
+            operations_by_partition.setdefault(partition, []).append(operation)
+        results, error = self.run_on_partitions(operations_by_partition)
+        for partition, operations in operations_by_partition.items():
+            for operation, data_id, data in operations[len(results[partition]):]:  # not performed
+                if data_id != DUMMY_DATA_ID:
+                    self.eviction_caches[partition][data_id] = data
+        self.max_eviction_cache_size = max(self.max_eviction_cache_size, self.get_eviction_cache_size())
+        self.metrics.observe('eviction_cache_size', self.get_eviction_cache_size())
+        if error is not None:
+            raise error
+
+    def get_eviction_cache_size(self) -> int:
+        """
+        return the number of blocks in all the eviction caches
+        """
+        return sum(len(eviction_cache) for eviction_cache in self.eviction_caches)
+
+    def collect_metrics(self):
+        """
+        add the metrics recorded by the worker processes since the last call to self.metrics
+        """
+        self.partitions.collect_metrics()
+
+    def get_max_stash_size(self) -> int:
+        """
+        return the largest stash size of the sub-clients
+        """
+        return self.partitions.get_max_stash_size()
+
+    def close(self):
+        self.partitions.close()
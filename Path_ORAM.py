@@ -1,81 +1,31 @@
 # Jonathan Birnbaum
 
-import math
-import random
-import string
-from Server import Server
-from Client import Client
-from Utils import Colors, color_text
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import Future
 from timeit import default_timer as timer
+from typing import Dict, Iterator, TextIO, Union
+from Server import Server
+from Client import Client, Operations, DATA_SIZE, DEFAULT_BUCKET_SIZE, get_encrypted_bucket_size
+from Utils import Colors, color_text, get_tree_height, get_tree_size
 
 STORE = '1'
 RETRIEVE = '2'
 DELETE = '3'
+UPDATE = '4'
 EXIT = '9'
-
-
-def test():
-    # for N in [3, 5, 10, 50, 100, 200, 500, 1000, 2000]:
-    for N in [3, 5, 10, 50, 100]:
-        # N = 500 # number of data blocks supported
-        print('--------------------')
-        print(f'N = {N}\n')
-        tree_height = max(0, math.ceil(math.log(N, 2)) - 1)  # it was proven that this is sufficient in 3.2
-        num_of_leaves = 2 ** tree_height
-        tree_size = (2 * num_of_leaves) - 1
-        print(f'tree_height: {tree_height}')
-        print(f'num_of_leaves: {num_of_leaves}')
-        print(f'tree_size: {tree_size}\n ')
-
-        random_strings = [''.join(random.choices(string.ascii_uppercase + string.digits, k=4)) for _ in
-                          range(N)]
-
-        server = Server(tree_size)
-        client = Client(N, server)
-
-        print('__STORE__')
-        total_request_time = 0
-        all_request_start = timer()
-        for index in range(N):
-            start = timer()
-            client.store_date(server, index, random_strings[index])
-            end = timer()
-            total_request_time += end - start
-        all_request_end = timer()
-
-        avg_request_time = total_request_time / N
-        total_time = all_request_end - all_request_start
-        print(f'total time: {total_time}')
-        print(f'Throughput: {N / total_time}')
-        print(f'Latency: {avg_request_time}')
-
-        print('\n__RETRIEVE__')
-        all_request_start = timer()
-        for index in range(N):
-            start = timer()
-            client.retrieve_data(server, index)
-            end = timer()
-            total_request_time += end - start
-        all_request_end = timer()
-        avg_request_time = total_request_time / N
-        total_time = all_request_end - all_request_start
-        print(f'total time: {total_time}')
-        print(f'Throughput: {N / total_time}')
-        print(f'Latency: {avg_request_time}')
-
-        print('\n__DELETE__')
-        all_request_start = timer()
-        for index in range(N):
-            start = timer()
-            client.delete_data(server, index)
-            end = timer()
-            total_request_time += end - start
-        all_request_end = timer()
-        avg_request_time = total_request_time / N
-        total_time = all_request_end - all_request_start
-        print(f'total time: {total_time}')
-        print(f'Throughput: {N / total_time}')
-        print(f'Latency: {avg_request_time}')
+STATE_KEY_VARIABLE = 'PATH_ORAM_STATE_KEY'  # environment variable with the key of the client state file
+BACKENDS = ['memory', 'mmap', 'remote']
+FORMATS = ['jsonl', 'csv']
+CSV_FIELDS = ['op', 'id', 'data']
+RESULT_FIELDS = ['line', 'op', 'id', 'status', 'data']
+# batch operation -> operation of Client.access
+BATCH_OPERATIONS = {'store': Operations.UPDATE, 'retrieve': Operations.READ, 'update': Operations.UPDATE,
+                    'delete': Operations.DELETE}
 
 
 def get_data_id_from_user() -> int:
@@ -86,29 +36,26 @@ def get_data_id_from_user() -> int:
     return int(data_id)
 
 
-def main():
+def run_interactive(N: int = None):
     print(color_text('===== Path ORAM =====', Colors.YELLOW))
-    N = input('Please enter number of data blocks support needed (positive integer): ')
-    while not N.isdigit() or int(N) < 1:
-        N = input(color_text('number of data blocks must be positive integer. choose again: ', Colors.RED))
-    N = int(N)
+    if N is None:
+        N = input('Please enter number of data blocks support needed (positive integer): ')
+        while not N.isdigit() or int(N) < 1:
+            N = input(color_text('number of data blocks must be positive integer. choose again: ', Colors.RED))
+        N = int(N)
     print('Data blocks supported:', N)
 
-    tree_height = max(0, math.ceil(math.log(N, 2)) - 1)  # it was proven that this is sufficient in 3.2
-    num_of_leaves = 2 ** tree_height
-    tree_size = (2 * num_of_leaves) - 1
-
-    server = Server(tree_size)
+    server = Server(get_tree_size(get_tree_height(N)))
     client = Client(N, server)
 
     user_request = None
     while user_request != EXIT:
-        request = input('\nChoose operation number: (1)store | (2)retrieve | (3)delete | (9)exit\n')
+        request = input('\nChoose operation number: (1)store | (2)retrieve | (3)delete | (4)update | (9)exit\n')
 
         if request == STORE:
             print(color_text('\n--- STORE ---', Colors.CYAN))
             data_id = get_data_id_from_user()
-            data = input('Insert data (string of 4 characters): ')
+            data = input(f'Insert data (string of up to {DATA_SIZE} characters): ')
             client.store_date(server, data_id, data)
             print('Done store')
 
@@ -128,13 +75,250 @@ def main():
             client.delete_data(server, data_id_to_delete)
             print('Done delete')
 
+        elif request == UPDATE:
+            print(color_text('\n--- UPDATE ---', Colors.CYAN))
+            data_id = get_data_id_from_user()
+            data = input(f'Insert new data (string of up to {DATA_SIZE} characters): ')
+            client.update_data(server, data_id, data)
+            print('Done update')
+
         elif request == EXIT:
             print('\nExiting')
             exit()
 
         else:
-            print(color_text('invalid operator. choose from: 1/2/3/9', Colors.RED))
+            print(color_text('invalid operator. choose from: 1/2/3/4/9', Colors.RED))
+
+
+# __________________ Batch mode __________________
+
+def read_operations(input_file: TextIO, input_format: str) -> Iterator[Union[str, Dict]]:
+    """
+    yield the records of a trace one at a time, unparsed (see parse_operation).
+    jsonl - one JSON object per line. csv - a header row op,id,data and one operation per row
+    """
+    if input_format == 'jsonl':
+        for line in input_file:
+            if line.strip():
+                yield line
+    else:
+        yield from csv.DictReader(input_file)
+
+
+def parse_operation(record: Union[str, Dict]) -> Dict:
+    """
+    return the operation of a trace record - a dict with op, id and (for store / update) data.
+    raise ValueError if the record is not a JSON object
+    """
+    operation = json.loads(record) if isinstance(record, str) else record
+    if not isinstance(operation, dict):
+        raise ValueError('operation must be a JSON object')
+    return operation
+
+
+def parse_data_id(data_id) -> int:
+    """
+    return the integer data id of an operation. raise ValueError if it is not an integer
+    """
+    if isinstance(data_id, float) and data_id.is_integer():
+        return int(data_id)
+    if isinstance(data_id, bool) or not isinstance(data_id, (int, str)):
+        raise ValueError(f'data id must be an integer, got {data_id!r}')
+    return int(data_id)
+
+
+def create_backend(args):
+    """
+    return the server object of the requested backend and a function which releases it
+    """
+    tree_size = get_tree_size(get_tree_height(args.N))
+    if args.backend == 'memory':
+        server = Server(tree_size)
+        return server, server.close
+    if args.backend == 'mmap':
+        from Storage import MmapStorage
+        server = Server(tree_size, MmapStorage(args.storage_file, tree_size,
+                                               get_encrypted_bucket_size(args.bucket_size, args.data_size)))
+        return server, server.close
+    from Network import RemoteServer
+    host, _, port = args.connect.rpartition(':')
+    remote_server = RemoteServer((host, int(port)) if port.isdigit() else args.connect)
+    return remote_server, remote_server.close
+
+
+def get_operation_request(operation: Dict, data_size: int):
+    """
+    return (access operation, data id, new data) of a trace operation. raise ValueError if it is invalid
+    """
+    op = operation.get('op')
+    if op not in BATCH_OPERATIONS:
+        raise ValueError(f'unknown operation {op}')
+    data_id = parse_data_id(operation.get('id'))
+    if op in ('retrieve', 'delete'):
+        return BATCH_OPERATIONS[op], data_id, None
+    data = operation.get('data')
+    data = data.encode('utf-8') if isinstance(data, str) else None
+    if data is None or len(data) > data_size:
+        raise ValueError(f'data must be a string of at most {data_size} bytes')
+    if op == 'store':  # keep the stored data if the id is in use - reported as an error
+        return Operations.UPDATE, data_id, lambda old_data: data if old_data is None else old_data
+    return Operations.UPDATE, data_id, lambda old_data: None if old_data is None else data
+
+
+def get_result(line_number: int, operation: Union[Dict, None], future: Future) -> Dict:
+    """
+    return the result record of a trace operation whose access was submitted (operation is None if the record
+    could not be parsed)
+    """
+    operation = operation or dict()
+    result = {'line': line_number, 'op': operation.get('op'), 'id': operation.get('id'), 'status': 'ok', 'data': None}
+    error = future.exception()
+    if error is not None:
+        error.__traceback__ = None  # the frames of a failed access refer to buckets of the storage
+        result['status'] = 'error'
+        result['data'] = str(error)
+        return result
+    old_data = future.result()
+    if operation['op'] == 'store':
+        if old_data is not None:
+            result['status'] = 'error'
+            result['data'] = 'data id is already in use'
+    elif old_data is None:
+        result['status'] = 'not_found'
+    elif operation['op'] == 'retrieve':
+        result['data'] = str(old_data, 'utf-8', errors='replace')
+    return result
+
+
+def run_batch(args):
+    """
+    stream the operations of a trace (file or stdin) through the client and stream one result per operation
+    (in order) to the output. at most pipeline_depth operations are in flight, so memory does not grow with
+    the length of the trace. a summary is printed to stderr at the end
+    """
+    input_format = args.format or ('csv' if args.batch.endswith('.csv') else 'jsonl')
+    input_file = sys.stdin if args.batch == '-' else open(args.batch, newline='')
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    server, close_server = create_backend(args)
+    if args.state_file and os.path.exists(args.state_file):  # reattach to the tree of an earlier run
+        from ClientState import load_client_state
+        client = load_client_state(args.state_file, os.environ[STATE_KEY_VARIABLE], server)
+    else:
+        client = Client(args.N, server, args.bucket_size, args.data_size, lazy_init=True)
+
+    concurrent_client = None
+    if args.pipeline_depth > 1:
+        from ConcurrentClient import ConcurrentClient
+        concurrent_client = ConcurrentClient(client, server, paths_per_round=args.pipeline_depth)
+
+    if input_format == 'csv':
+        writer = csv.DictWriter(output_file, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        write_result = writer.writerow
+    else:
+        def write_result(result: Dict):
+            output_file.write(json.dumps(result) + '\n')
+
+    in_flight = deque()  # (line number, operation, future, is access) in trace order
+    summary = {'operations': 0, 'errors': 0, 'failed_accesses': 0}
+
+    def write_oldest_result():
+        line_number, operation, future, is_access = in_flight.popleft()
+        result = get_result(line_number, operation, future)
+        summary['operations'] += 1
+        summary['errors'] += result['status'] == 'error'
+        # an access which failed (not an invalid operation) may leave the client state out of sync with the tree
+        summary['failed_accesses'] += is_access and future.exception() is not None
+        write_result(result)
+
+    def submit_operation(record):
+        """
+        return (operation, future of its result, True if it was submitted as an access) of a trace record
+        """
+        future = Future()
+        try:
+            operation = parse_operation(record)
+            request = get_operation_request(operation, args.data_size)
+        except (ValueError, TypeError) as e:  # json.JSONDecodeError is a ValueError
+            future.set_exception(e)
+            return None, future, False
+        if concurrent_client is not None:
+            return operation, concurrent_client.submit(*request), True
+        try:
+            future.set_result(client.access(server, *request))
+        except Exception as e:
+            future.set_exception(e)
+        return operation, future, True
+
+    start = timer()
+    completed = False
+    try:
+        for line_number, record in enumerate(read_operations(input_file, input_format), 1):
+            in_flight.append((line_number, *submit_operation(record)))
+            while len(in_flight) >= args.pipeline_depth:
+                write_oldest_result()
+        while in_flight:
+            write_oldest_result()
+        completed = True
+    finally:
+        if concurrent_client is not None:
+            concurrent_client.close()
+        total_time = timer() - start
+        if args.state_file:
+            if completed and not summary['failed_accesses']:
+                from ClientState import save_client_state
+                server.flush()
+                save_client_state(client, args.state_file, os.environ[STATE_KEY_VARIABLE])
+            else:  # the batch was stopped (e.g. reading the trace or writing a result failed) or an access failed
+                reason = 'an access failed' if completed else 'the batch did not complete'
+                print(color_text(f'Error: {reason} - the client state was not saved to {args.state_file}',
+                                 Colors.RED), file=sys.stderr)
+        in_flight.clear()  # the errors of failed accesses may refer to buckets of the storage
+        close_server()
+        output_file.flush()
+        for opened_file in (input_file, output_file):
+            if opened_file not in (sys.stdin, sys.stdout):
+                opened_file.close()
+
+    print(f'{summary["operations"]} operations ({summary["errors"]} errors) in {total_time:.3f} seconds, '
+          f'{summary["operations"] / total_time if total_time else 0:.1f} ops/s', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Path ORAM client - interactive, or batch mode over a trace')
+    parser.add_argument('-N', type=int, help='number of data blocks supported (asked for in interactive mode)')
+    parser.add_argument('--batch', help='run the operations of this trace file (- for stdin) instead of the menu')
+    parser.add_argument('--format', choices=FORMATS, help='trace format (default: by file extension, else jsonl)')
+    parser.add_argument('--output', default='-', help='file for the results of a batch (default: stdout)')
+    parser.add_argument('--backend', choices=BACKENDS, default='memory')
+    parser.add_argument('--storage-file', help='tree file of the mmap backend')
+    parser.add_argument('--state-file', help='restore the client state from this file if it exists and save it at '
+                                             f'the end of the batch (encrypted with ${STATE_KEY_VARIABLE})')
+    parser.add_argument('--connect', help='address of a network server for the remote backend (host:port or '
+                                          'unix socket path)')
+    parser.add_argument('--pipeline-depth', type=int, default=1,
+                        help='number of operations in flight in batch mode (served in rounds if above 1)')
+    parser.add_argument('--bucket-size', type=int, default=DEFAULT_BUCKET_SIZE)
+    parser.add_argument('--data-size', type=int, default=DATA_SIZE)
+    args = parser.parse_args()
+
+    if args.batch is None:
+        run_interactive(args.N)
+        return
+    if args.N is None or args.N < 1:
+        parser.error('batch mode needs a positive -N')
+    if args.pipeline_depth < 1:
+        parser.error('--pipeline-depth must be positive')
+    if args.backend == 'mmap' and not args.storage_file:
+        parser.error('the mmap backend needs --storage-file')
+    if args.state_file and not os.environ.get(STATE_KEY_VARIABLE):
+        parser.error(f'--state-file needs the key in the environment variable {STATE_KEY_VARIABLE}')
+    if args.state_file and args.backend == 'memory':
+        parser.error('--state-file needs a backend whose tree outlives the run (mmap or remote)')
+    if args.backend == 'remote' and not args.connect:
+        parser.error('the remote backend needs --connect')
+    run_batch(args)
 
 
-# test()
-main()
+if __name__ == '__main__':
+    main()
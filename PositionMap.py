@@ -0,0 +1,123 @@
+# Jonathan Birnbaum
+
+import sys
+from array import array
+
+ARRAY_TYPE_CODE = 'i'  # 4 bytes signed int per data id
+ABSENT_LEAF = -1  # leaf index stored in ArrayPositionMap for data ids that are not mapped
+
+
+class DictPositionMap(dict):
+    """
+    position map kept in the client memory - a dict from data id to its leaf index
+    """
+
+    def remap(self, data_id: int, new_leaf_index: int):
+        """
+        assign the given leaf to the data id and return its previous leaf (None if it was not mapped)
+        """
+        old_leaf_index = self.get(data_id)
+        self[data_id] = new_leaf_index
+        return old_leaf_index
+
+    def remap_existing(self, data_id: int, new_leaf_index: int):
+        """
+        assign the given leaf to the data id only if it is mapped. return its previous leaf (None if it was not
+        mapped - the map is not changed)
+        """
+        old_leaf_index = self.get(data_id)
+        if old_leaf_index is not None:
+            self[data_id] = new_leaf_index
+        return old_leaf_index
+
+    def memory_usage(self) -> int:
+        """
+        return the client memory used by the position map in bytes
+        """
+        return sys.getsizeof(self) + sum(sys.getsizeof(data_id) + sys.getsizeof(leaf_index)
+                                         for data_id, leaf_index in self.items())
+
+
+class ArrayPositionMap:
+    """
+    compact position map for dense integer data ids - a typed array indexed by data id (ABSENT_LEAF for data ids
+    which are not mapped), about 4 bytes per block. data ids outside 0..num_of_ids-1 fall back to a sparse dict
+    """
+
+    def __init__(self, num_of_ids: int):
+        self.leaves = array(ARRAY_TYPE_CODE, [ABSENT_LEAF]) * num_of_ids
+        self.sparse_leaves = DictPositionMap()
+        self.num_of_entries = 0  # number of mapped data ids in the array
+
+    def is_dense(self, data_id: int) -> bool:
+        """
+        return True if the given data id is kept in the array (not in the sparse fallback)
+        """
+        return 0 <= data_id < len(self.leaves)
+
+    def get(self, data_id: int, default=None):
+        if not self.is_dense(data_id):
+            return self.sparse_leaves.get(data_id, default)
+        leaf_index = self.leaves[data_id]
+        return default if leaf_index == ABSENT_LEAF else leaf_index
+
+    def remap(self, data_id: int, new_leaf_index: int):
+        """
+        assign the given leaf to the data id and return its previous leaf (None if it was not mapped)
+        """
+        if not self.is_dense(data_id):
+            return self.sparse_leaves.remap(data_id, new_leaf_index)
+        old_leaf_index = self.get(data_id)
+        self.leaves[data_id] = new_leaf_index
+        self.num_of_entries += old_leaf_index is None
+        return old_leaf_index
+
+    def remap_existing(self, data_id: int, new_leaf_index: int):
+        """
+        assign the given leaf to the data id only if it is mapped. return its previous leaf (None if it was not
+        mapped - the map is not changed)
+        """
+        if not self.is_dense(data_id):
+            return self.sparse_leaves.remap_existing(data_id, new_leaf_index)
+        old_leaf_index = self.get(data_id)
+        if old_leaf_index is not None:
+            self.leaves[data_id] = new_leaf_index
+        return old_leaf_index
+
+    def pop(self, data_id: int, default=None):
+        if not self.is_dense(data_id):
+            return self.sparse_leaves.pop(data_id, default)
+        old_leaf_index = self.get(data_id)
+        if old_leaf_index is None:
+            return default
+        self.leaves[data_id] = ABSENT_LEAF
+        self.num_of_entries -= 1
+        return old_leaf_index
+
+    def __getitem__(self, data_id: int):
+        leaf_index = self.get(data_id)
+        if leaf_index is None:
+            raise KeyError(data_id)
+        return leaf_index
+
+    def __setitem__(self, data_id: int, leaf_index: int):
+        self.remap(data_id, leaf_index)
+
+    def __contains__(self, data_id: int):
+        return self.get(data_id) is not None
+
+    def __len__(self):
+        return self.num_of_entries + len(self.sparse_leaves)
+
+    def memory_usage(self) -> int:
+        """
+        return the client memory used by the position map in bytes
+        """
+        return sys.getsizeof(self.leaves) + self.sparse_leaves.memory_usage()
+
+
+def fits_in_memory(num_of_ids: int, memory_budget: int) -> bool:
+    """
+    return True if an ArrayPositionMap of num_of_ids entries can be kept in a client memory of memory_budget bytes
+    """
+    return num_of_ids * array(ARRAY_TYPE_CODE).itemsize <= memory_budget
@@ -0,0 +1,157 @@
+# Jonathan Birnbaum
+
+import struct
+from typing import Callable, Dict, List, Union
+from Client import Client, Operations, DEFAULT_BUCKET_SIZE
+from PositionMap import ArrayPositionMap, DictPositionMap, fits_in_memory
+from Server import Server
+from Utils import get_tree_height, get_tree_size
+
+LABEL_FORMAT = '>I'  # leaf index + 1 of a single data id (0 - data id is not mapped)
+LABEL_SIZE = struct.calcsize(LABEL_FORMAT)
+DEFAULT_LABELS_PER_BLOCK = 32
+ROUND_TRIPS_PER_ACCESS = 2  # read path + write path of one access to every level
+
+
+def create_position_map(num_of_ids: int, memory_budget: int = None, labels_per_block: int = DEFAULT_LABELS_PER_BLOCK,
+                        server_factory: Callable = Server, bucket_size: int = DEFAULT_BUCKET_SIZE):
+    """
+    return a position map for data ids 0..num_of_ids-1. if it does not fit in memory_budget bytes of client
+    memory the map is stored recursively in smaller ORAMs until the last level fits in an ArrayPositionMap
+    :param num_of_ids: number of data ids the map should support
+    :param memory_budget: client memory in bytes for the position map (None - no limit)
+    :param labels_per_block: number of leaf labels packed in each block of a recursive level
+    :param server_factory: function from a tree size to the server which stores that level
+    :param bucket_size: bucket size of the ORAMs of the recursive levels
+    """
+    if memory_budget is None:
+        return DictPositionMap()
+    if fits_in_memory(num_of_ids, memory_budget):
+        return ArrayPositionMap(num_of_ids)
+    return RecursivePositionMap(num_of_ids, memory_budget, labels_per_block, server_factory, bucket_size)
+
+
+class RecursivePositionMap:
+    """
+    position map which is stored in a smaller ORAM - the leaf labels of labels_per_block consecutive data ids
+    are packed in one block. the position map of that ORAM is created the same way, so the recursion stops
+    when the map of the smallest ORAM fits in the client memory budget.
+    supports data ids 0..num_of_ids-1
+    """
+
+    def __init__(self, num_of_ids: int, memory_budget: int, labels_per_block: int = DEFAULT_LABELS_PER_BLOCK,
+                 server_factory: Callable = Server, bucket_size: int = DEFAULT_BUCKET_SIZE):
+        self.num_of_ids = num_of_ids
+        self.labels_per_block = labels_per_block
+        self.num_of_blocks = -(-num_of_ids // labels_per_block)
+        self.num_of_entries = 0
+
+        inner_position_map = create_position_map(self.num_of_blocks, memory_budget, labels_per_block,
+                                                 server_factory, bucket_size)
+        self.server = server_factory(get_tree_size(get_tree_height(self.num_of_blocks)))
+        # the tree of a level is initialized lazily - a block of labels which was never written is all unmapped
+        self.client = Client(self.num_of_blocks, self.server, bucket_size, labels_per_block * LABEL_SIZE,
+                             inner_position_map, lazy_init=True)
+
+    def update_label(self, data_id: int, new_leaf_index: Union[int, None], change: bool = True,
+                     only_if_mapped: bool = False):
+        """
+        read the label of the given data id and replace it with new_leaf_index (None - unmap) in a single
+        access to the ORAM of this level. return the previous leaf index (None if it was not mapped).
+        if only_if_mapped is True an unmapped label is left unmapped
+        """
+        if not 0 <= data_id < self.num_of_ids:
+            raise KeyError(f'data id {data_id} is out of the range of the recursive position map')
+        block_id, label_offset = divmod(data_id, self.labels_per_block)
+        label_offset *= LABEL_SIZE
+        new_label = 0 if new_leaf_index is None else new_leaf_index + 1
+
+        def update_block(labels_block: Union[bytes, None]) -> bytes:
+            labels_block = bytearray(labels_block or bytes(self.labels_per_block * LABEL_SIZE))
+            old_label, = struct.unpack_from(LABEL_FORMAT, labels_block, label_offset)
+            if change and (old_label != 0 or not only_if_mapped):
+                struct.pack_into(LABEL_FORMAT, labels_block, label_offset, new_label)
+            return bytes(labels_block)
+
+        old_labels_block = self.client.access(self.server, Operations.UPDATE, block_id, update_block)
+        old_label = 0
+        if old_labels_block is not None:
+            old_label, = struct.unpack_from(LABEL_FORMAT, old_labels_block, label_offset)
+        old_leaf_index = None if old_label == 0 else old_label - 1
+
+        if change and (old_leaf_index is not None or not only_if_mapped):
+            self.num_of_entries += (new_leaf_index is not None) - (old_leaf_index is not None)
+        return old_leaf_index
+
+    def get(self, data_id: int, default=None):
+        leaf_index = self.update_label(data_id, None, change=False)
+        return default if leaf_index is None else leaf_index
+
+    def remap(self, data_id: int, new_leaf_index: int):
+        """
+        assign the given leaf to the data id and return its previous leaf (None if it was not mapped)
+        """
+        return self.update_label(data_id, new_leaf_index)
+
+    def remap_existing(self, data_id: int, new_leaf_index: int):
+        """
+        assign the given leaf to the data id only if it is mapped. return its previous leaf (None if it was not
+        mapped - the map is not changed). a single access to every level, like remap
+        """
+        return self.update_label(data_id, new_leaf_index, only_if_mapped=True)
+
+    def pop(self, data_id: int, default=None):
+        leaf_index = self.update_label(data_id, None)
+        return default if leaf_index is None else leaf_index
+
+    def __getitem__(self, data_id: int):
+        leaf_index = self.get(data_id)
+        if leaf_index is None:
+            raise KeyError(data_id)
+        return leaf_index
+
+    def __setitem__(self, data_id: int, leaf_index: int):
+        self.remap(data_id, leaf_index)
+
+    def __contains__(self, data_id: int):
+        return 0 <= data_id < self.num_of_ids and self.get(data_id) is not None
+
+    def __len__(self):
+        return self.num_of_entries
+
+    def memory_usage(self) -> int:
+        """
+        return the client memory used by the position map in bytes (stashes and the last level map)
+        """
+        return self.get_stash_memory_usage() + self.client.position_map.memory_usage()
+
+    def get_stash_memory_usage(self) -> int:
+        """
+        return the client memory used by the stash of this level in bytes (estimated by the block sizes)
+        """
+        return len(self.client.stash) * self.client.block_size
+
+    def get_levels_report(self) -> List[Dict]:
+        """
+        return a report for every recursive level (from this one down): number of blocks, client memory
+        used by the level and server round trips added to each access of the data ORAM. an access makes one
+        lookup (remap, remap_existing or pop), and a second one (pop) only when an update removes the data or
+        is made to a data id which is not stored
+        """
+        level_report = {'num_of_blocks': self.num_of_blocks,
+                        'tree_size': self.client.tree_size,
+                        'max_stash_size': self.client.max_stash_size,
+                        'client_memory': self.get_stash_memory_usage(),
+                        'round_trips_per_access': ROUND_TRIPS_PER_ACCESS}
+        inner_position_map = self.client.position_map
+        if isinstance(inner_position_map, RecursivePositionMap):
+            return [level_report] + inner_position_map.get_levels_report()
+        return [level_report, {'num_of_blocks': len(inner_position_map),
+                               'client_memory': inner_position_map.memory_usage(),
+                               'round_trips_per_access': 0}]
+
+    def get_round_trips_per_access(self) -> int:
+        """
+        return the number of extra server round trips that every position map lookup costs
+        """
+        return sum(level['round_trips_per_access'] for level in self.get_levels_report())
@@ -0,0 +1,333 @@
+# Jonathan Birnbaum
+
+import secrets
+import struct
+from typing import Callable, Iterable, List, Tuple, Union
+from Client import Client, Operations, DATA_SIZE, DEFAULT_BUCKET_SIZE, NONCE_SIZE, TAG_SIZE, \
+    decrypt_bucket_ciphertext, encrypt_bucket_plaintext, get_block_size, pack_block_into
+from Metrics import DISABLED_METRICS
+from Server import Server
+from Utils import *
+
+DEFAULT_NUM_OF_DUMMIES = 6  # S - dummy slots in each bucket
+DEFAULT_EVICTION_RATE = 3  # A - number of accesses between two path evictions
+METADATA_HEADER_FORMAT = '>I'  # number of slots read since the bucket was written
+# every slot: is real, data id, leaf index, is valid (not read since the bucket was written)
+SLOT_METADATA_FORMAT = '>BqqB'
+METADATA_HEADER_SIZE = struct.calcsize(METADATA_HEADER_FORMAT)
+SLOT_METADATA_SIZE = struct.calcsize(SLOT_METADATA_FORMAT)
+IS_REAL = 0
+DATA_ID = 1
+LEAF_INDEX = 2
+IS_VALID = 3
+secure_random = secrets.SystemRandom()
+
+
+def get_entries_per_bucket(bucket_size: int, num_of_dummies: int) -> int:
+    """
+    return the number of server entries of a bucket - its metadata and a slot for each block
+    """
+    return 1 + bucket_size + num_of_dummies
+
+
+def get_ring_server_size(N: int, bucket_size: int = DEFAULT_BUCKET_SIZE,
+                         num_of_dummies: int = DEFAULT_NUM_OF_DUMMIES) -> int:
+    """
+    return the number of entries of the server storage of a Ring ORAM of N data blocks
+    """
+    return get_tree_size(get_tree_height(N)) * get_entries_per_bucket(bucket_size, num_of_dummies)
+
+
+def get_ring_entry_size(bucket_size: int = DEFAULT_BUCKET_SIZE, num_of_dummies: int = DEFAULT_NUM_OF_DUMMIES,
+                        data_size: int = DATA_SIZE) -> int:
+    """
+    return the size in bytes of the largest encrypted server entry (the slot size of the server storage)
+    """
+    metadata_size = METADATA_HEADER_SIZE + ((bucket_size + num_of_dummies) * SLOT_METADATA_SIZE)
+    return NONCE_SIZE + TAG_SIZE + max(metadata_size, get_block_size(data_size))
+
+
+def pack_bucket_metadata(count: int, slots: List[List]) -> bytearray:
+    plaintext = bytearray(struct.pack(METADATA_HEADER_FORMAT, count))
+    for slot in slots:
+        plaintext += struct.pack(SLOT_METADATA_FORMAT, *slot)
+    return plaintext
+
+
+def unpack_bucket_metadata(plaintext: bytearray) -> Tuple[int, List[List]]:
+    """
+    return the count and the slots metadata [is_real, data_id, leaf_index, is_valid] of a bucket
+    """
+    count, = struct.unpack_from(METADATA_HEADER_FORMAT, plaintext)
+    slots = [list(slot) for slot in struct.iter_unpack(SLOT_METADATA_FORMAT, plaintext[METADATA_HEADER_SIZE:])]
+    return count, slots
+
+
+class RingClient(Client):
+    """
+    Ring ORAM client (Ren et al.) over the same Server interface. every bucket has bucket_size (Z) real and
+    num_of_dummies (S) dummy slots in a random permutation, each slot a separate server entry, and encrypted
+    metadata with the content of every slot. an access reads the metadata of a path and then only one slot per
+    bucket - the requested block or a fresh dummy. a bucket read num_of_dummies times is reshuffled early, and
+    every eviction_rate (A) accesses a path is evicted in reverse lexicographic order, like a Path ORAM write
+    back of that path.
+    bulk_load, treetop levels, lazy init and the batched path methods of Client are not supported
+    """
+
+    def __init__(self, N: int, server: Server, bucket_size: int = DEFAULT_BUCKET_SIZE, data_size: int = DATA_SIZE,
+                 num_of_dummies: int = DEFAULT_NUM_OF_DUMMIES, eviction_rate: int = DEFAULT_EVICTION_RATE,
+                 position_map=None, crypto_pool=None, metrics=DISABLED_METRICS):
+        """
+        :param N: number of data blocks supported
+        :param server: server object with get_ring_server_size() entries
+        :param bucket_size: number of real slots in each bucket (Z)
+        :param data_size: maximal size in bytes of the data of each block
+        :param num_of_dummies: number of dummy slots in each bucket (S)
+        :param eviction_rate: number of accesses between two path evictions (A)
+        :param position_map: position map to use (DictPositionMap by default)
+        :param crypto_pool: pool which encrypts / decrypts the entries in parallel (None - serially)
+        :param metrics: Metrics which count and time the phases of every access (disabled by default)
+        """
+        self.num_of_dummies = num_of_dummies
+        self.eviction_rate = eviction_rate
+        self.slots_per_bucket = bucket_size + num_of_dummies
+        self.entries_per_bucket = get_entries_per_bucket(bucket_size, num_of_dummies)
+        self.num_of_accesses = 0
+        self.num_of_evictions = 0  # G - the next evicted path in reverse lexicographic order
+        self.num_of_early_reshuffles = 0
+        super().__init__(N, server, bucket_size, data_size, position_map, crypto_pool=crypto_pool, metrics=metrics)
+
+    def initialize_tree_with_dummies(self, server: Server):
+        """
+        fill the tree storage of the given server with buckets of dummy slots, one server call per level
+        """
+        for level in range(self.tree_height + 1):
+            level_indices = get_node_indices_of_level(level)
+            self.write_buckets(server, level_indices, [[] for _ in level_indices])
+
+    # __________________ Server entries __________________
+
+    def get_metadata_index(self, bucket_index: int) -> int:
+        return bucket_index * self.entries_per_bucket
+
+    def get_slot_index(self, bucket_index: int, slot_number: int) -> int:
+        return (bucket_index * self.entries_per_bucket) + 1 + slot_number
+
+    def encrypt_entries(self, entry_indices: List[int], plaintexts: List[bytearray]) -> List[bytearray]:
+        """
+        encrypt the given entries (metadata or slots), each authenticated with its server index
+        """
+        nonces = [self.generate_nonce() for _ in entry_indices]
+        with self.metrics.phase('encrypt'):
+            encrypted_entries = self.crypto_map(encrypt_bucket_plaintext, [self.secret_key] * len(nonces), nonces,
+                                                entry_indices, plaintexts)
+        self.metrics.increment('encryptions', len(encrypted_entries))
+        return encrypted_entries
+
+    def decrypt_entries(self, entry_indices: List[int], encrypted_entries: List[bytes]) -> List[bytearray]:
+        """
+        return the plaintexts of the given encrypted entries. raise ValueError if decryption or authentication of
+        any entry didn't succeed
+        """
+        try:
+            with self.metrics.phase('decrypt'):
+                plaintexts = self.crypto_map(decrypt_bucket_ciphertext, [self.secret_key] * len(entry_indices),
+                                             entry_indices, encrypted_entries)
+        except ValueError as e:
+            self.metrics.record_error('decryption', e)
+            print("Incorrect decryption")
+            raise
+        self.metrics.increment('decryptions', len(plaintexts))
+        return plaintexts
+
+    def read_entries(self, server: Server, entry_indices: List[int], online: bool = False) -> List[bytearray]:
+        """
+        read and decrypt the given server entries in a single server call
+        :param online: the entries are read before the requested block is known (counted as online bytes)
+        """
+        with self.metrics.phase('read_path'):
+            encrypted_entries = server.get_buckets_by_indices(entry_indices)
+        self.metrics.increment('server_calls')
+        if online and self.metrics.enabled:
+            self.metrics.increment('online_bytes', sum(len(entry) for entry in encrypted_entries))
+        return self.decrypt_entries(entry_indices, encrypted_entries)
+
+    def write_entries(self, server: Server, entry_indices: List[int], plaintexts: List[bytearray]):
+        """
+        encrypt and write the given server entries in a single server call
+        """
+        encrypted_entries = self.encrypt_entries(entry_indices, plaintexts)
+        with self.metrics.phase('write_path'):
+            server.write_buckets_by_indices(entry_indices, encrypted_entries)
+        self.metrics.increment('server_calls')
+
+    # __________________ Buckets __________________
+
+    def read_metadata(self, server: Server, bucket_indices: List[int], online: bool = False) -> List[List]:
+        """
+        return [count, slots] of every given bucket (see unpack_bucket_metadata)
+        """
+        plaintexts = self.read_entries(server, [self.get_metadata_index(bucket_index)
+                                                for bucket_index in bucket_indices], online)
+        return [list(unpack_bucket_metadata(plaintext)) for plaintext in plaintexts]
+
+    def write_metadata(self, server: Server, bucket_indices: List[int], metadatas: List[List]):
+        self.write_entries(server, [self.get_metadata_index(bucket_index) for bucket_index in bucket_indices],
+                           [pack_bucket_metadata(count, slots) for count, slots in metadatas])
+
+    def write_buckets(self, server: Server, bucket_indices: List[int],
+                      blocks_of_buckets: List[List[Tuple[int, int, bytes]]]):
+        """
+        write the given buckets from scratch in a single server call - the real blocks and dummies in randomly
+        permuted slots, and metadata with nothing read
+        """
+        entry_indices, plaintexts = [], []
+        for bucket_index, blocks in zip(bucket_indices, blocks_of_buckets):
+            slot_numbers = list(range(self.slots_per_bucket))
+            secure_random.shuffle(slot_numbers)
+            slots = [[False, 0, 0, True] for _ in range(self.slots_per_bucket)]
+            slot_plaintexts = [bytearray(self.block_size) for _ in range(self.slots_per_bucket)]  # dummy blocks
+            for slot_number, (data_id, leaf_index, data) in zip(slot_numbers, blocks):
+                slots[slot_number] = [True, data_id, leaf_index, True]
+                pack_block_into(slot_plaintexts[slot_number], 0, data_id, leaf_index, data)
+            entry_indices.append(self.get_metadata_index(bucket_index))
+            plaintexts.append(pack_bucket_metadata(0, slots))
+            entry_indices.extend(self.get_slot_index(bucket_index, slot_number)
+                                 for slot_number in range(self.slots_per_bucket))
+            plaintexts.extend(slot_plaintexts)
+        self.write_entries(server, entry_indices, plaintexts)
+
+    def read_valid_slots(self, server: Server, bucket_indices: List[int], metadatas: List[List]) \
+            -> List[List[Tuple[int, int, memoryview]]]:
+        """
+        read exactly bucket_size valid slots of every given bucket (all its real blocks and random dummies) in a
+        single server call. return the real blocks of every bucket
+        """
+        slot_indices = []
+        for bucket_index, (_, slots) in zip(bucket_indices, metadatas):
+            real_slots = [number for number, slot in enumerate(slots) if slot[IS_REAL] and slot[IS_VALID]]
+            dummy_slots = [number for number, slot in enumerate(slots) if not slot[IS_REAL] and slot[IS_VALID]]
+            read_slots = real_slots + secure_random.sample(dummy_slots, self.bucket_size - len(real_slots))
+            slot_indices.extend(self.get_slot_index(bucket_index, number) for number in sorted(read_slots))
+        plaintexts = self.read_entries(server, slot_indices)
+        return [[block for plaintext in plaintexts[offset:offset + self.bucket_size]
+                 for block in self.unpack_bucket(plaintext)]
+                for offset in range(0, len(plaintexts), self.bucket_size)]
+
+    # __________________ Ring ORAM __________________
+
+    def read_block_to_stash(self, leaf_index: int, data_id: int, server: Server) -> Tuple[List[int], List[List]]:
+        """
+        read the metadata of the path to the given leaf, then one slot of every bucket on it - the block of the
+        given data id if the bucket holds it, otherwise a random valid dummy - and move the block to the stash.
+        the read slots are marked invalid. return the path indices and the updated metadata of the path
+        """
+        path_indices = self.tree_index.get_path(leaf_index)
+        metadatas = self.read_metadata(server, path_indices, online=True)
+        slot_indices = []
+        for bucket_index, metadata in zip(path_indices, metadatas):
+            slots = metadata[1]
+            slot_number = next((number for number, slot in enumerate(slots)
+                                if slot[IS_REAL] and slot[IS_VALID] and slot[DATA_ID] == data_id), None)
+            if slot_number is None:
+                slot_number = secrets.choice([number for number, slot in enumerate(slots)
+                                              if not slot[IS_REAL] and slot[IS_VALID]])
+            slots[slot_number][IS_VALID] = False
+            metadata[0] += 1
+            slot_indices.append(self.get_slot_index(bucket_index, slot_number))
+
+        for plaintext in self.read_entries(server, slot_indices, online=True):
+            self.add_blocks_to_stash(self.unpack_bucket(plaintext))
+        self.write_metadata(server, path_indices, metadatas)
+        return path_indices, metadatas
+
+    def early_reshuffle(self, server: Server, path_indices: List[int], metadatas: List[List]):
+        """
+        rewrite the buckets of the path which were read num_of_dummies times, so every bucket always has a valid
+        dummy to read
+        """
+        reshuffled = [(bucket_index, metadata) for bucket_index, metadata in zip(path_indices, metadatas)
+                      if metadata[0] >= self.num_of_dummies]
+        if not reshuffled:
+            return
+        bucket_indices = [bucket_index for bucket_index, _ in reshuffled]
+        blocks_of_buckets = self.read_valid_slots(server, bucket_indices, [metadata for _, metadata in reshuffled])
+        self.write_buckets(server, bucket_indices, blocks_of_buckets)
+        self.num_of_early_reshuffles += len(reshuffled)
+
+    def get_eviction_leaf(self, eviction_number: int) -> int:
+        """
+        return the leaf of the given eviction in reverse lexicographic order (the leaf offset is the eviction
+        number with its tree_height bits reversed)
+        """
+        leaf_offset = int(format(eviction_number % self.tree_index.num_of_leaves, f'0{self.tree_height}b')[::-1], 2) \
+            if self.tree_height else 0
+        return self.tree_index.get_leaf(leaf_offset)
+
+    def evict_path(self, server: Server):
+        """
+        read the valid blocks of the next path in reverse lexicographic order to the stash, greedily evict the
+        stash to it (see Client.evict_to_path) and write all its buckets from scratch
+        """
+        leaf_index = self.get_eviction_leaf(self.num_of_evictions)
+        self.num_of_evictions += 1
+        path_indices = self.tree_index.get_path(leaf_index)
+        metadatas = self.read_metadata(server, path_indices)
+        for blocks in self.read_valid_slots(server, path_indices, metadatas):
+            self.add_blocks_to_stash(blocks)
+        with self.metrics.phase('evict'):
+            blocks_of_buckets = self.evict_to_path(leaf_index)
+        self.write_buckets(server, path_indices, blocks_of_buckets)
+        self.update_stash_metrics()
+
+    def access(self, server: Server, operation: str, data_id: int,
+               new_data: Union[bytes, Callable] = None) -> Union[bytes, None]:
+        """
+        single Ring ORAM access: assign the data a new random leaf, read the block from the path of its old leaf
+        (one slot per bucket), perform the operation on the stash, reshuffle the buckets of the path that ran out
+        of dummies and evict a path every eviction_rate accesses.
+        :return: the data stored with the given id before the operation, None if there was no such data
+        """
+        with self.metrics.phase('access'):
+            new_leaf_index = self.generate_new_leaf_index()
+            with self.metrics.phase('position_map'):
+                if operation == Operations.DELETE:
+                    leaf_index = self.position_map.pop(data_id, None)
+                elif operation == Operations.READ:  # a read of a data id which is not stored does not map it
+                    leaf_index = self.position_map.remap_existing(data_id, new_leaf_index)
+                else:
+                    leaf_index = self.position_map.remap(data_id, new_leaf_index)
+            if leaf_index is None:  # data is not stored - read a random path
+                leaf_index = self.get_leaf_of_unmapped(data_id)
+            path_indices, metadatas = self.read_block_to_stash(leaf_index, data_id, server)
+            try:
+                data = self.apply_operation(operation, data_id, new_data, new_leaf_index)
+            finally:
+                if operation in (Operations.WRITE, Operations.UPDATE) and data_id not in self.stash:  # no block
+                    self.position_map.pop(data_id, None)
+                self.finish_access(server, path_indices, metadatas)
+        self.metrics.increment(f'{operation}_accesses')
+        return data
+
+    def dummy_access(self, server: Server):
+        """
+        read a random dummy slot of every bucket on a random path - looks the same to the server as any other
+        access (see Client.dummy_access)
+        """
+        with self.metrics.phase('access'):
+            path_indices, metadatas = self.read_block_to_stash(self.generate_new_leaf_index(), None, server)
+            self.finish_access(server, path_indices, metadatas)
+
+    def finish_access(self, server: Server, path_indices: List[int], metadatas: List[List]):
+        """
+        reshuffle the buckets of the read path that ran out of dummies and evict a path every eviction_rate
+        accesses
+        """
+        self.early_reshuffle(server, path_indices, metadatas)
+        self.num_of_accesses += 1
+        if self.num_of_accesses % self.eviction_rate == 0:
+            self.evict_path(server)
+
+    def bulk_load(self, server: Server, items: Iterable[Tuple[int, Union[str, bytes]]]) -> int:
+        print(color_text('Error: bulk load is not supported by Ring ORAM', Colors.RED))
+        return 0
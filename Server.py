@@ -1,6 +1,9 @@
 # Jonathan Birnbaum
 
 from typing import List
+from Metrics import DISABLED_METRICS
+from Storage import MemoryStorage
+from Utils import TreeIndex
 
 
 class Server:
@@ -9,17 +12,32 @@ class Server:
     the server should not be able to determine the clients access pattern to the storage
     """
 
-    def __init__(self, tree_size: int):
-        self.tree_storage = [None] * tree_size  # storage is a list of buckets (list of lists)
+    def __init__(self, tree_size: int, storage=None, metrics=DISABLED_METRICS):
+        """
+        :param tree_size: number of buckets in the tree
+        :param storage: storage backend of the buckets (MemoryStorage by default, or MmapStorage)
+        :param metrics: Metrics which count the buckets and bytes read and written (disabled by default)
+        """
+        self.metrics = metrics
+        # storage is indexed by bucket index, each bucket is one encrypted bytes object
+        self.tree_storage = storage if storage is not None else MemoryStorage(tree_size)
+        self.tree_height = (tree_size + 1).bit_length() - 2
+        self.tree_index = TreeIndex(self.tree_height)
 
     def get_bucket_by_index(self, index: int):
         """
         return the node bucket in the given tree index
         """
         try:
-            return self.tree_storage[index]
+            bucket = self.tree_storage[index]
         except IndexError as e:
+            self.metrics.record_error('server_read', e)
             print("Error:", e)
+            return None
+        self.metrics.increment('server_buckets_read')
+        if bucket is not None:
+            self.metrics.increment('server_bytes_read', len(bucket))
+        return bucket
 
     def get_buckets_by_indices(self, indices_list: List[int]):
         """
@@ -27,8 +45,42 @@ class Server:
         """
         return [self.get_bucket_by_index(index) for index in indices_list]
 
-    def write_bucket_by_index(self, index: int, bucket: List):
+    def write_bucket_by_index(self, index: int, bucket: bytes):
         """
         replace the given bucket with the one in the given index in the tree
         """
         self.tree_storage[index] = bucket
+        self.metrics.increment('server_buckets_written')
+        self.metrics.increment('server_bytes_written', len(bucket))
+
+    def write_buckets_by_indices(self, indices_list: List[int], buckets: List[bytes]):
+        """
+        replace the buckets in the given tree indices with the given buckets (in the same order)
+        """
+        for index, bucket in zip(indices_list, buckets):
+            self.write_bucket_by_index(index, bucket)
+
+    def read_path(self, leaf_index: int, from_level: int = 0) -> List[bytes]:
+        """
+        return the buckets of the nodes from root (or from the given level) to the given tree leaf in a single call
+        """
+        return self.get_buckets_by_indices(self.tree_index.get_path(leaf_index)[from_level:])
+
+    def write_path(self, leaf_index: int, buckets: List[bytes], from_level: int = 0):
+        """
+        replace all the buckets of the nodes from root (or from the given level) to the given tree leaf
+        in a single call
+        """
+        self.write_buckets_by_indices(self.tree_index.get_path(leaf_index)[from_level:], buckets)
+
+    def flush(self):
+        """
+        make all written buckets durable (no-op for in-memory storage)
+        """
+        self.tree_storage.flush()
+
+    def close(self):
+        """
+        flush and release the storage
+        """
+        self.tree_storage.close()
@@ -0,0 +1,110 @@
+# Jonathan Birnbaum
+
+import mmap
+import os
+import struct
+from typing import Union
+
+FILE_MAGIC = b'PATHORAM'
+FILE_HEADER_FORMAT = '>8sQQ'  # magic, number of slots (tree size), slot size in bytes
+FILE_HEADER_SIZE = struct.calcsize(FILE_HEADER_FORMAT)
+SLOT_LENGTH_FORMAT = '>I'  # every slot starts with the length of the bucket stored in it (0 - never written)
+SLOT_LENGTH_SIZE = struct.calcsize(SLOT_LENGTH_FORMAT)
+
+
+class MemoryStorage:
+    """
+    in-memory storage of the server - a list of encrypted buckets. lost when the process ends
+    """
+
+    def __init__(self, tree_size: int):
+        self.buckets = [None] * tree_size
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def __getitem__(self, index: int):
+        return self.buckets[index]
+
+    def __setitem__(self, index: int, bucket: bytes):
+        if isinstance(bucket, memoryview):  # own a copy of buckets which are views of other buffers
+            bucket = bytes(bucket)
+        self.buckets[index] = bucket
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MmapStorage:
+    """
+    persistent storage of the server - one file holding a flat array of fixed-size bucket slots which is
+    memory-mapped. buckets are returned as zero-copy memoryview slices of the file and written in place.
+    reopening an existing file keeps the tree that is stored in it
+    """
+
+    def __init__(self, file_path: str, tree_size: int, bucket_size_in_bytes: int):
+        self.tree_size = tree_size
+        self.slot_size = SLOT_LENGTH_SIZE + bucket_size_in_bytes
+        file_size = FILE_HEADER_SIZE + (tree_size * self.slot_size)
+
+        is_new_file = not os.path.exists(file_path) or os.path.getsize(file_path) == 0
+        self.file = open(file_path, 'w+b' if is_new_file else 'r+b')
+        if is_new_file:
+            self.file.write(struct.pack(FILE_HEADER_FORMAT, FILE_MAGIC, tree_size, bucket_size_in_bytes))
+            self.file.truncate(file_size)  # slots are zero - never written
+        else:
+            magic, stored_tree_size, stored_bucket_size = struct.unpack(FILE_HEADER_FORMAT,
+                                                                        self.file.read(FILE_HEADER_SIZE))
+            if (magic, stored_tree_size, stored_bucket_size) != (FILE_MAGIC, tree_size, bucket_size_in_bytes):
+                self.file.close()
+                raise ValueError(f'{file_path} does not hold a tree of {tree_size} buckets of '
+                                 f'{bucket_size_in_bytes} bytes')
+
+        self.mmap = mmap.mmap(self.file.fileno(), file_size)
+        self.view = memoryview(self.mmap)
+
+    def __len__(self):
+        return self.tree_size
+
+    def get_slot_offset(self, index: int) -> int:
+        """
+        return the offset in the file of the slot of the given bucket index
+        """
+        if not 0 <= index < self.tree_size:
+            raise IndexError(f'bucket index {index} out of range')
+        return FILE_HEADER_SIZE + (index * self.slot_size)
+
+    def __getitem__(self, index: int) -> Union[memoryview, None]:
+        offset = self.get_slot_offset(index)
+        bucket_length, = struct.unpack_from(SLOT_LENGTH_FORMAT, self.mmap, offset)
+        if bucket_length == 0:  # never written
+            return None
+        bucket_offset = offset + SLOT_LENGTH_SIZE
+        return self.view[bucket_offset:bucket_offset + bucket_length]
+
+    def __setitem__(self, index: int, bucket: bytes):
+        offset = self.get_slot_offset(index)
+        if len(bucket) > self.slot_size - SLOT_LENGTH_SIZE:
+            raise ValueError(f'bucket of {len(bucket)} bytes does not fit in a slot')
+        struct.pack_into(SLOT_LENGTH_FORMAT, self.mmap, offset, len(bucket))
+        bucket_offset = offset + SLOT_LENGTH_SIZE
+        self.view[bucket_offset:bucket_offset + len(bucket)] = bucket
+
+    def flush(self):
+        """
+        write all changes to the disk (checkpoint)
+        """
+        self.mmap.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """
+        flush and close the file. buckets returned before (memoryviews) must be released first
+        """
+        self.flush()
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
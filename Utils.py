@@ -1,7 +1,25 @@
 # Jonathan Birnbaum
 
 import math
-from typing import List
+import secrets
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+PATH_CACHE_SIZE = 4096  # paths kept by every TreeIndex (all of them in trees with at most this many leaves)
+
+
+def get_tree_height(N: int) -> int:
+    """
+    get the height of the tree needed for N data blocks
+    """
+    return max(0, math.ceil(math.log(N, 2)) - 1)  # it was proven that this is sufficient in 3.2
+
+
+def get_tree_size(tree_height: int) -> int:
+    """
+    get the number of nodes in a full tree of the given height
+    """
+    return (2 * (2 ** tree_height)) - 1
 
 
 def get_left_child_index(index: int):
@@ -22,20 +40,37 @@ def get_parent_index(index: int):
     """
     get parent index of the given node index in tree
     """
-    return math.floor((index - 1) / 2)
+    return (index - 1) >> 1
+
+
+def get_level_of_node(index: int) -> int:
+    """
+    get the tree level of the given node index (the root is in level 0)
+    """
+    return (index + 1).bit_length() - 1
+
+
+def get_ancestor_index(leaf_index: int, level: int, tree_height: int) -> int:
+    """
+    get the index of the node in the given level on the path from root to the given leaf
+    """
+    return ((leaf_index + 1) >> (tree_height - level)) - 1
 
 
 def get_path_to_leaf(leaf_index: int, tree_height: int) -> List[int]:
     """
     get list of indices of nodes from root to given leaf
     """
-    path = []
-    curr_node = leaf_index
-    for i in range(tree_height + 1):
-        path.append(curr_node)
-        curr_node = get_parent_index(curr_node)
+    return [get_ancestor_index(leaf_index, level, tree_height) for level in range(tree_height + 1)]
+
 
-    return path[::-1]
+def get_deepest_common_level(leaf_index_a: int, leaf_index_b: int, tree_height: int) -> int:
+    """
+    get the deepest tree level shared by the paths from root to the two given leaves
+    """
+    first_leaf_index = (2 ** tree_height) - 1
+    different_bits = (leaf_index_a - first_leaf_index) ^ (leaf_index_b - first_leaf_index)
+    return tree_height - different_bits.bit_length()
 
 
 def get_node_indices_of_level(level_index: int):
@@ -46,6 +81,54 @@ def get_node_indices_of_level(level_index: int):
     return list(range(first_index_in_level, (2 * first_index_in_level) + 1))
 
 
+class TreeIndex:
+    """
+    index arithmetic of a tree of a fixed height - cached paths per leaf and O(1) ancestor queries. the paths
+    are immutable tuples, so they are shared by all the callers (and threads)
+    """
+
+    def __init__(self, tree_height: int, path_cache_size: int = PATH_CACHE_SIZE):
+        """
+        :param tree_height: height of the tree (the leaves are in this level)
+        :param path_cache_size: maximal number of paths kept (least recently used ones are dropped)
+        """
+        self.tree_height = tree_height
+        self.num_of_leaves = 2 ** tree_height
+        self.first_leaf_index = self.num_of_leaves - 1
+        self.tree_size = get_tree_size(tree_height)
+        self.get_path = lru_cache(maxsize=path_cache_size)(self.compute_path)
+
+    def compute_path(self, leaf_index: int) -> Tuple[int, ...]:
+        """
+        return the indices of the nodes from root to the given leaf (uncached - use get_path)
+        """
+        return tuple(get_path_to_leaf(leaf_index, self.tree_height))
+
+    def get_union_of_paths(self, leaf_indices: Sequence[int]) -> List[int]:
+        """
+        return the sorted indices of the nodes on the paths from root to the given leaves, each one once
+        """
+        return sorted({index for leaf_index in leaf_indices for index in self.get_path(leaf_index)})
+
+    def get_ancestor(self, leaf_index: int, level: int) -> int:
+        """
+        return the node in the given level on the path from root to the given leaf
+        """
+        return get_ancestor_index(leaf_index, level, self.tree_height)
+
+    def get_leaf(self, leaf_offset: int) -> int:
+        """
+        return the node index of the leaf in the given offset from the left
+        """
+        return self.first_leaf_index + leaf_offset
+
+    def generate_random_leaf(self) -> int:
+        """
+        return a uniformly random leaf index
+        """
+        return self.first_leaf_index + secrets.randbelow(self.num_of_leaves)
+
+
 def color_text(text, rgb):
     r, g, b = rgb
     return f"\033[38;2;{r};{g};{b}m{text}\033[0m"
@@ -0,0 +1,124 @@
+# Jonathan Birnbaum
+
+import unittest
+from Client import Client, Operations
+from PartitionedClient import PartitionedClient
+from RingClient import RingClient, get_ring_server_size
+from Server import Server
+from Utils import get_tree_height, get_tree_size
+
+N = 64
+
+
+def fail(data):
+    raise RuntimeError('update failed')
+
+
+class FailingServer(Server):
+    """
+    server whose next read_path / write_path call raises once a failure is requested
+    """
+
+    failing_call = None
+
+    def read_path(self, *args, **kwargs):
+        self.fail_if_requested('read_path')
+        return super().read_path(*args, **kwargs)
+
+    def write_path(self, *args, **kwargs):
+        self.fail_if_requested('write_path')
+        return super().write_path(*args, **kwargs)
+
+    def fail_if_requested(self, call: str):
+        if self.failing_call == call:
+            self.failing_call = None
+            raise ConnectionError(f'{call} failed')
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(get_tree_size(get_tree_height(N)))
+        self.client = Client(N, self.server)
+
+    def store_all(self, num_of_items: int):
+        for data_id in range(num_of_items):
+            self.client.store_date(self.server, data_id, str(data_id))
+
+    def assert_all_stored(self, num_of_items: int):
+        for data_id in range(num_of_items):
+            self.assertEqual(self.client.retrieve_data(self.server, data_id), str(data_id))
+
+    def test_raising_update_keeps_the_block(self):
+        self.store_all(N // 2)
+        for round_number in range(20):
+            with self.assertRaises(RuntimeError):
+                self.client.update_data(self.server, 5, fail)
+            # the path is written back, so no stale copy of a block is left in the tree to be read again later
+            for data_id in range(N // 2):
+                self.client.update_data(self.server, data_id, str(round_number * 100 + data_id))
+            for data_id in range(N // 2):
+                self.assertEqual(self.client.retrieve_data(self.server, data_id), str(round_number * 100 + data_id))
+
+    def test_failed_server_calls_keep_the_blocks(self):
+        server = FailingServer(get_tree_size(get_tree_height(N)))
+        client = Client(N, server)
+        expected = {data_id: str(data_id) for data_id in range(N // 2)}
+        for data_id, data in expected.items():
+            client.store_date(server, data_id, data)
+        for round_number in range(20):
+            server.failing_call = 'read_path' if round_number % 2 else 'write_path'
+            with self.assertRaises(ConnectionError):
+                client.update_data(server, round_number, 'new')
+            if round_number % 2 == 0:  # the update is done before the write fails
+                expected[round_number] = 'new'
+            for data_id, data in expected.items():
+                self.assertEqual(client.retrieve_data(server, data_id), data)
+
+    def test_raising_update_of_ring_client_keeps_the_block(self):
+        server = Server(get_ring_server_size(N))
+        client = RingClient(N, server)
+        for data_id in range(N // 2):
+            client.access(server, Operations.WRITE, data_id, str(data_id).encode())
+        for _ in range(20):
+            with self.assertRaises(RuntimeError):
+                client.access(server, Operations.UPDATE, 5, fail)
+        for data_id in range(N // 2):
+            self.assertEqual(bytes(client.access(server, Operations.READ, data_id)), str(data_id).encode())
+
+    def test_raising_update_of_partitioned_client_keeps_the_blocks(self):
+        for use_processes in (False, True):
+            with self.subTest(use_processes=use_processes):
+                client = PartitionedClient(N, 4, use_processes=use_processes)
+                try:
+                    client.access_many([(Operations.WRITE, data_id, str(data_id).encode())
+                                        for data_id in range(N // 2)])
+                    for _ in range(20):
+                        with self.assertRaises(RuntimeError):
+                            client.access_many([(Operations.UPDATE, 3, fail), (Operations.READ, 4, None)])
+                    results = client.access_many([(Operations.READ, data_id, None) for data_id in range(N // 2)])
+                    self.assertEqual([bytes(data) for data in results],
+                                     [str(data_id).encode() for data_id in range(N // 2)])
+                finally:
+                    client.close()
+
+    def test_bulk_load_after_lazy_deletes(self):
+        self.store_all(4)
+        for data_id in range(4):
+            self.client.delete_data(self.server, data_id)
+        self.assertEqual(self.client.bulk_load(self.server, ((data_id, str(data_id)) for data_id in range(N))), N)
+        self.assertEqual(self.client.deleted_leaves, {})
+        self.assert_all_stored(N)
+
+    def test_lazy_deletes_are_bounded(self):
+        self.store_all(N)
+        for data_id in range(N):
+            self.client.delete_data(self.server, data_id)
+            self.assertLessEqual(len(self.client.deleted_leaves), self.client.max_deleted_leaves)
+        self.assertEqual(len(self.client.position_map), 0)
+        for data_id in range(N):
+            self.assertIsNone(self.client.retrieve_bytes(self.server, data_id))
+
+
+if __name__ == '__main__':
+    unittest.main()